@@ -195,6 +195,54 @@ CELERY_RESULT_BACKEND = "redis://redis:6379"
 CELERY_TIMEZONE = 'Europe/Moscow'
 CELERY_CREATE_MISSING_QUEUES = True
 CELERY_TASK_DEFAULT_QUEUE = os.getenv('QUEUE_DEFAULT', default='celery')
+# Задачи расчета идут в свою очередь: её воркеры в docker-compose.yml перезапускают процесс,
+# превысивший лимит памяти, остальные очереди лимит не затрагивает
+QUEUE_SCORING = os.getenv('QUEUE_SCORING', default='scoring')
+CELERY_TASK_ROUTES = {
+    name: {'queue': QUEUE_SCORING}
+    for name in ('create_scoring_features', 'score_scoring_partition', 'finish_distributed_scoring')
+}
+
+# Feature import
+# Объекты слоя пишутся через COPY пачками по столько строк, в одной транзакции на слой (layer) или на пачку (chunk)
+FEATURE_COPY_CHUNK_SIZE = int(os.getenv('FEATURE_COPY_CHUNK_SIZE', default=50000))
+FEATURE_COPY_TRANSACTION = os.getenv('FEATURE_COPY_TRANSACTION', default='layer')
+# Файлы от этого размера в байтах делятся на части, которые загружают параллельно несколько воркеров
+FEATURE_PARALLEL_MIN_BYTES = int(os.getenv('FEATURE_PARALLEL_MIN_BYTES', default=64 * 1024 * 1024))
+FEATURE_CHUNK_BYTES = int(os.getenv('FEATURE_CHUNK_BYTES', default=32 * 1024 * 1024))
+
+# Scoring
+SCORING_BACKEND = os.getenv('SCORING_BACKEND', default='vectorized')
+SCORING_NORMALIZATION = os.getenv('SCORING_NORMALIZATION', default='city')
+# Размер пула движка parallel на одну задачу. Каждый дочерний процесс воркера celery (-c) запускает свой пул,
+# поэтому по умолчанию 1; больше стоит ставить для воркера с -c 1 или --pool solo, где пул состоит из процессов
+SCORING_WORKERS = int(os.getenv('SCORING_WORKERS', default=1))
+SCORING_GRID_PATH = os.getenv('SCORING_GRID_PATH', default=os.path.join(BASE_DIR, 'maps_app', 'scoring', 'grid.gpkg'))
+SCORING_EXPORT_CHUNK_SIZE = int(os.getenv('SCORING_EXPORT_CHUNK_SIZE', default=100000))
+SCORING_CACHE_DIR = os.getenv('SCORING_CACHE_DIR', default=os.path.join(BASE_DIR, 'maps_app', 'scoring', 'cache'))
+SCORING_PROGRESS_SAVE_INTERVAL = float(os.getenv('SCORING_PROGRESS_SAVE_INTERVAL', default=5))
+SCORING_H3_RESOLUTION = int(os.getenv('SCORING_H3_RESOLUTION', default=8))
+SCORING_PRIMARY_CACHE = bool(os.environ.get("SCORING_PRIMARY_CACHE", "true").lower() == "true")
+SCORING_MAX_CONCURRENT_TASKS = int(os.getenv('SCORING_MAX_CONCURRENT_TASKS', default=3))
+SCORING_MAX_TASKS_PER_COMPANY = int(os.getenv('SCORING_MAX_TASKS_PER_COMPANY', default=2))
+SCORING_RECOVERY_GRACE = int(os.getenv('SCORING_RECOVERY_GRACE', default=600))
+# Распределенный расчет: размер части сетки в ячейках, SCORING_CACHE_DIR должен быть общим для всех воркеров
+SCORING_PARTITION_CELLS = int(os.getenv('SCORING_PARTITION_CELLS', default=200000))
+# Экономный по памяти расчет: бюджет памяти процесса и наибольший фрагмент сетки в ячейках.
+# По бюджету подбирается размер следующего фрагмента; процесс, вышедший за лимит --max-memory-per-child
+# воркера расчетов, перезапускается после задачи
+SCORING_MEMORY_BUDGET_MB = int(os.getenv('SCORING_MEMORY_BUDGET_MB', default=2048))
+SCORING_CHUNK_CELLS = int(os.getenv('SCORING_CHUNK_CELLS', default=100000))
+# Приближенный расчет через БПФ: размер пикселя растра в метрах EPSG:3857 и ячеек сетки на один растр
+SCORING_FFT_PIXEL_SIZE = float(os.getenv('SCORING_FFT_PIXEL_SIZE', default=25))
+SCORING_FFT_TILE_CELLS = int(os.getenv('SCORING_FFT_TILE_CELLS', default=200000))
+# Предпросмотр расчета по окну карты считается синхронно, поэтому размер окна ограничен
+SCORING_PREVIEW_MAX_CELLS = int(os.getenv('SCORING_PREVIEW_MAX_CELLS', default=20000))
+# Хранение слоев расчета: features - полигоны в объектах, grid_scores - только баллы ячеек с общей геометрией сетки.
+# grid_scores включается, когда все читатели объектов слоя (тайлы, API, выгрузки) поддерживают баллы ячеек
+SCORING_LAYER_STORAGE = os.getenv('SCORING_LAYER_STORAGE', default='features')
+# Ячейки с нулевым баллом в слой не записываются и на карте не отображаются
+SCORING_SKIP_ZERO_SCORES = bool(os.environ.get("SCORING_SKIP_ZERO_SCORES", "false").lower() == "true")
 
 # Jazzmin
 JAZZMIN_SETTINGS = {
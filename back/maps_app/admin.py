@@ -1,5 +1,9 @@
 from django.contrib import admin
 from .models import Map, MapLayer, Feature, MapStyle, POIConfig, CreateScoringMapLayerTask
+from .checkpoints import clear_checkpoint
+from .partitions import get_partition_task_ids
+from .metrics import summarize_stages
+from .tasks import dispatch_scoring_tasks
 from geosight.celery import app
 from django.utils import timezone
 
@@ -79,22 +83,47 @@ class POIConfigAdmin(admin.ModelAdmin):
 
 @admin.register(CreateScoringMapLayerTask)
 class CreateScoringMapLayerTaskAdmin(admin.ModelAdmin):
-    list_display = ['task_id', 'layer', 'status', 'calculate_scoring_progress', 'polygon_import_progress', 'error_message']
-    list_filter = ['status']
-    search_fields = ['task_id', 'layer__name']
-    actions = ['kill_task']
+    list_display = ['task_id', 'layer', 'company', 'status', 'backend', 'calculate_scoring_progress', 'polygon_import_progress',
+                    'source_task', 'stage_times', 'error_message']
+    list_filter = ['status', 'backend', 'company']
+    search_fields = ['task_id', 'layer__name', 'cache_key']
+    readonly_fields = ['metrics', 'stage_times', 'cache_key', 'params', 'started_at']
+    actions = ['kill_task', 'resume_task']
+
+    def stage_times(self, obj):
+        summary = summarize_stages(obj.metrics)
+        return ', '.join(f"{name}: {total['seconds']:.1f} с" for name, total in summary.items()) or '-'
+
+    stage_times.short_description = "Время по этапам"
 
     def kill_task(self, request, queryset):
         for task in queryset:
-            if task.status == 'in_progress':
-                app.control.revoke(task.task_id, terminate=True)
+            if task.status in ('in_progress', 'pending'):
+                if task.status == 'in_progress':
+                    app.control.revoke([task.task_id, *get_partition_task_ids(task)], terminate=True)
 
                 task.status = 'killed'
                 task.end_time = timezone.now()
+                clear_checkpoint(task)
                 task.save()
+                task.fail_followers('Задача с результатом расчета была остановлена')
 
-                task.layer.delete()
+                if task.layer:
+                    task.layer.delete()
+        dispatch_scoring_tasks()
         self.message_user(request, "Выбранные задачи были убиты и соответствующие слои удалены.")
 
     kill_task.short_description = "Убить выбранные задачи в работе и удалить соответствующие слои"
 
+    def resume_task(self, request, queryset):
+        # Упавшие задачи возвращаются в очередь и продолжают расчет с контрольной точки
+        for task in queryset.filter(status='failed', source_task__isnull=True, layer__isnull=False):
+            task.status = 'pending'
+            task.error_message = None
+            task.end_time = None
+            task.save()
+        dispatch_scoring_tasks()
+        self.message_user(request, "Выбранные упавшие задачи поставлены в очередь.")
+
+    resume_task.short_description = "Перезапустить упавшие задачи с контрольной точки"
+
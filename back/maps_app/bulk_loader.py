@@ -0,0 +1,180 @@
+import io
+import logging
+import struct
+import time
+from contextlib import nullcontext
+from itertools import repeat
+
+import numpy as np
+import shapely
+from django.conf import settings
+from django.db import connection, transaction
+
+from maps_app.models import Feature, MapLayer
+
+logger = logging.getLogger(__name__)
+
+COPY_NULL = '\\N'
+# Спецсимволы текстового формата COPY
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+HEX_DIGITS = np.array([f'{byte:02x}'.encode() for byte in range(256)], dtype='S2')
+# Тип полигона с флагом SRID в EWKB
+EWKB_POLYGON = 0x20000003
+
+
+def escape_json(value):
+    # Управляющие символы в JSON всегда экранированы, поэтому для COPY удваиваем только обратную косую черту
+    return value.replace('\\', '\\\\') if '\\' in value else value
+
+
+def to_hex_ewkb(geometries, srid=4326):
+    """
+    Hex EWKB of geometries for COPY, None stays None.
+    GEOS writes binary WKB several times faster than hex, so the hex encoding is done by Python.
+    """
+    wkb = shapely.to_wkb(shapely.set_srid(geometries, srid), include_srid=True)
+    return [None if value is None else value.hex() for value in wkb.tolist()]
+
+
+def rings_to_hex_ewkb(coords, ring_offsets, srid=4326):
+    """
+    Hex EWKB of single-ring polygons given as ragged arrays (closed ring coordinates and ring offsets).
+    Bytes are assembled by numpy for all polygons with the same number of vertices at once, without GEOS.
+    """
+    lengths = np.diff(ring_offsets)
+    result = np.empty(len(lengths), dtype=object)
+    for length in np.unique(lengths).tolist():
+        rows = np.flatnonzero(lengths == length)
+        header = np.frombuffer(struct.pack('<BIIII', 1, EWKB_POLYGON, srid, 1, length), dtype=np.uint8)
+        ring_coords = coords[ring_offsets[rows, None] + np.arange(length)].astype('<f8')
+        wkb = np.hstack([np.broadcast_to(header, (len(rows), len(header))),
+                         ring_coords.reshape(len(rows), -1).view(np.uint8)])
+        result[rows] = HEX_DIGITS[wkb].view(f'S{2 * wkb.shape[1]}').ravel().astype(str)
+    return result
+
+
+def check_column_lengths(properties, feature_types, geometries, h3_indexes=None):
+    """
+    Raises ValueError unless every column has a value per row of `properties`.
+    A single feature type and missing H3 indexes apply to all rows and are not checked.
+    """
+    columns = {'geometries': geometries}
+    if not isinstance(feature_types, str):
+        columns['feature_types'] = feature_types
+    if h3_indexes is not None:
+        columns['h3_indexes'] = h3_indexes
+    for name, column in columns.items():
+        if len(column) != len(properties):
+            raise ValueError(f'Got {len(column)} {name} for {len(properties)} feature rows')
+
+
+def copy_feature_rows(cursor, layer_id, feature_types, properties, geometries, h3_indexes=None):
+    """
+    Writes feature rows of a layer into maps_app_feature with one COPY FROM STDIN.
+    `feature_types` is a type per row or one type for all rows, `properties` are serialized JSON objects,
+    `geometries` are hex EWKB strings or None, `h3_indexes` are H3 cells of the rows if any. Returns the number of rows.
+    """
+    check_column_lengths(properties, feature_types, geometries, h3_indexes)
+    if not isinstance(feature_types, str) and len(set(feature_types)) == 1:
+        # Обычно у всех объектов один тип, экранируем его один раз
+        feature_types = feature_types[0]
+    if isinstance(feature_types, str):
+        feature_types = repeat(feature_types.translate(COPY_ESCAPES))
+    else:
+        feature_types = (feature_type.translate(COPY_ESCAPES) for feature_type in feature_types)
+    if h3_indexes is None:
+        h3_indexes = repeat(None)
+    buffer = io.StringIO()
+    rows = 0
+    for feature_type, feature_properties, geometry, h3_index in zip(feature_types, properties, geometries, h3_indexes):
+        buffer.write(f'{layer_id}\t{feature_type}\t{escape_json(feature_properties)}'
+                     f'\t{COPY_NULL if geometry is None else geometry}\t{COPY_NULL if h3_index is None else h3_index}\n')
+        rows += 1
+    buffer.seek(0)
+    cursor.copy_expert(
+        f'COPY {Feature._meta.db_table} (map_layer_id, type, properties, geometry, h3_index) FROM STDIN', buffer
+    )
+    return rows
+
+
+class LayerLoadCancelled(Exception):
+    pass
+
+
+def lock_layer_load(cursor, layer_id):
+    """
+    Locks the layer row in share mode until the end of the transaction, raises LayerLoadCancelled
+    when the load of the layer has failed or the layer is gone.
+    """
+    # Обработчик ошибки загрузки меняет строку слоя и потому ждёт пишущие части, а части после него видят ошибку
+    cursor.execute(f'SELECT error FROM {MapLayer._meta.db_table} WHERE id = %s FOR SHARE', [layer_id])
+    row = cursor.fetchone()
+    if row is None or row[0]:
+        raise LayerLoadCancelled(f'Load of layer {layer_id} has been cancelled')
+
+
+class FeatureLoader:
+    """
+    Buffers feature rows of a layer and streams them into the database with COPY every chunk_size rows.
+    With transaction_scope='layer' the whole layer is loaded in one transaction and appears at once,
+    with 'chunk' every COPY commits on its own.
+    A guarded loader is one of several chunks of a layer: every COPY first takes lock_layer_load.
+    """
+
+    def __init__(self, layer_id, chunk_size=None, transaction_scope=None, guard=False):
+        self.layer_id = layer_id
+        self.guard = guard
+        self.chunk_size = chunk_size or settings.FEATURE_COPY_CHUNK_SIZE
+        self.transaction_scope = transaction_scope or settings.FEATURE_COPY_TRANSACTION
+        # Строки копятся по колонкам: тип, свойства, геометрия, индекс H3
+        self.columns = ([], [], [], [])
+        self.saved = 0
+        self.started = None
+        self._layer_transaction = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        if self.transaction_scope == 'layer':
+            self._layer_transaction = transaction.atomic()
+            self._layer_transaction.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if self._layer_transaction is not None:
+                self._layer_transaction.__exit__(exc_type, exc, traceback)
+        if exc_type is None:
+            logger.info('Layer %s: %s features loaded, %.0f features/s', self.layer_id, self.saved, self.rate)
+        return False
+
+    @property
+    def rate(self):
+        return self.saved / max(time.perf_counter() - self.started, 1e-9)
+
+    def add(self, feature_types, properties, geometries, h3_indexes=None):
+        # Проверяем до записи в буфер, иначе колонки разъедутся и строки смешаются при следующем COPY
+        check_column_lengths(properties, feature_types, geometries, h3_indexes)
+        types_column, properties_column, geometries_column, h3_column = self.columns
+        added = len(properties)
+        properties_column.extend(properties)
+        types_column.extend([feature_types] * added if isinstance(feature_types, str) else feature_types)
+        geometries_column.extend(geometries)
+        h3_column.extend([None] * added if h3_indexes is None else h3_indexes)
+        if len(properties_column) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[1]:
+            return
+        feature_types, properties, geometries, h3_indexes = self.columns
+        self.columns = ([], [], [], [])
+        # В режиме 'layer' уже открыта транзакция слоя, отдельная не нужна
+        scope = transaction.atomic() if self._layer_transaction is None else nullcontext()
+        with scope, connection.cursor() as cursor:
+            if self.guard:
+                lock_layer_load(cursor, self.layer_id)
+            self.saved += copy_feature_rows(cursor, self.layer_id, feature_types, properties, geometries,
+                                            h3_indexes)
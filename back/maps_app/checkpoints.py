@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from django.conf import settings
+
+from maps_app.poi_snapshots import check_table_name, get_poi_snapshot_version
+
+
+def has_checkpoints(task):
+    # Задачи без записи в базе (например, в бенчмарке) контрольные точки не сохраняют
+    return getattr(task, 'pk', None) is not None
+
+
+def get_checkpoint_dir(task):
+    return os.path.join(settings.SCORING_CACHE_DIR, 'checkpoints', str(task.pk))
+
+
+def get_category_params(poi, max_distance, polygon_radius):
+    return [get_poi_snapshot_version(poi), max_distance, float(polygon_radius)]
+
+
+def load_category_checkpoint(task, poi, max_distance, polygon_radius, cells):
+    """
+    Returns primary scores of a category saved by a previous run of the task, None if there are none or
+    they were computed with other parameters or another POI snapshot.
+    """
+    if not has_checkpoints(task):
+        return None
+    params = task.checkpoint.get('categories', {}).get(poi)
+    if params is None or params != get_category_params(poi, max_distance, polygon_radius):
+        return None
+    try:
+        scores_pp = np.load(os.path.join(get_checkpoint_dir(task), f'{check_table_name(poi)}.npy'))
+    except (OSError, ValueError):
+        return None
+    return scores_pp if len(scores_pp) == cells else None
+
+
+def save_category_checkpoint(task, poi, max_distance, polygon_radius, scores_pp):
+    if not has_checkpoints(task):
+        return
+
+    checkpoint_dir = get_checkpoint_dir(task)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.scores-', suffix='.npy', dir=checkpoint_dir)
+    with os.fdopen(fd, 'wb') as file:
+        np.save(file, np.asarray(scores_pp, dtype=np.float64))
+    os.replace(tmp_path, os.path.join(checkpoint_dir, f'{check_table_name(poi)}.npy'))
+
+    task.checkpoint.setdefault('categories', {})[poi] = get_category_params(poi, max_distance, polygon_radius)
+    task.save(update_fields=['checkpoint'])
+
+
+def get_import_offset(task, total_polygons):
+    if not has_checkpoints(task):
+        return 0
+    checkpoint = task.checkpoint.get('import', {})
+    return checkpoint['offset'] if checkpoint.get('total') == total_polygons else 0
+
+
+def save_import_checkpoint(task, offset, total_polygons):
+    # Вызывается в транзакции вместе с записью пачки объектов, смещение и объекты в базе всегда согласованы
+    if not has_checkpoints(task):
+        return
+    task.checkpoint['import'] = {'offset': offset, 'total': total_polygons}
+    task.save(update_fields=['checkpoint'])
+
+
+def reset_import_checkpoint(task):
+    if has_checkpoints(task) and task.checkpoint.pop('import', None) is not None:
+        task.save(update_fields=['checkpoint'])
+
+
+def clear_checkpoint(task):
+    task.checkpoint = {}
+    if has_checkpoints(task):
+        shutil.rmtree(get_checkpoint_dir(task), ignore_errors=True)
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+from maps_app.bulk_loader import rings_to_hex_ewkb, to_hex_ewkb
+from maps_app.h3_scoring import h3_cell_boundaries
+
+H3_COLUMN = 'h3'
+LAT_COLUMNS = ('lat', 'latitude')
+LON_COLUMNS = ('lon', 'lng', 'longitude')
+
+
+def read_csv_chunks(file, chunk_size):
+    # Значения остаются строками, как и раньше в свойствах объектов, пустые ячейки - пустые строки
+    return pd.read_csv(file, dtype=str, keep_default_na=False, chunksize=chunk_size)
+
+
+def find_column(columns, names):
+    return next((name for name in names if name in columns), None)
+
+
+def parse_h3_indexes(values):
+    # Индексы H3 в CSV записаны шестнадцатеричной строкой
+    return np.fromiter((int(value, 16) for value in values), dtype=np.int64, count=len(values))
+
+
+def get_h3_wkb(cells):
+    """
+    Hex EWKB of H3 cell hexagons, every distinct cell is built once.
+    """
+    unique_cells, inverse = np.unique(cells, return_inverse=True)
+    coords, ring_offsets = h3_cell_boundaries(unique_cells)
+    return rings_to_hex_ewkb(coords, ring_offsets)[inverse]
+
+
+def get_point_wkb(lon, lat):
+    return to_hex_ewkb(shapely.points(lon.astype(np.float64), lat.astype(np.float64)))
+
+
+def get_csv_properties(chunk):
+    # Строки JSON всей пачки собирает pandas, переводы строк внутри значений экранированы.
+    # Записи делим только по '\n': splitlines() режет ещё и по U+2028, \x85 и другим символам внутри значений
+    if chunk.columns.empty or chunk.empty:
+        return ['{}'] * len(chunk)
+    return chunk.to_json(orient='records', lines=True, force_ascii=False).rstrip('\n').split('\n')
+
+
+def parse_csv_chunk(chunk):
+    """
+    Converts a chunk of CSV rows into columns of features: hex EWKB geometries, serialized properties
+    and H3 indexes (None for point CSVs). Rows are either H3 cells (`h3` column) or points (lat/lon columns),
+    the geometry columns are not copied into the properties.
+    """
+    columns = chunk.columns
+    if H3_COLUMN in columns:
+        cells = parse_h3_indexes(chunk[H3_COLUMN].to_numpy())
+        return get_h3_wkb(cells).tolist(), get_csv_properties(chunk.drop(columns=H3_COLUMN)), cells.tolist()
+
+    lat_column, lon_column = find_column(columns, LAT_COLUMNS), find_column(columns, LON_COLUMNS)
+    if lat_column is None or lon_column is None:
+        raise ValueError('CSV must have an h3 column or latitude and longitude columns')
+    geometries = get_point_wkb(chunk[lon_column].to_numpy(), chunk[lat_column].to_numpy())
+    return geometries, get_csv_properties(chunk.drop(columns=[lat_column, lon_column])), None
@@ -0,0 +1,144 @@
+import json
+import re
+
+# Файл читается кусками по столько символов, в памяти держится только текущий кусок и одна запись
+READ_CHUNK_SIZE = 1024 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+# Символы, которыми может продолжаться число JSON
+NUMBER_CHARS = frozenset('0123456789+-.eE')
+DECODER = json.JSONDecoder()
+
+
+class JsonStream:
+    """
+    Reads JSON values one by one from a text file without loading the whole document.
+    """
+
+    def __init__(self, file, chunk_size=READ_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        # Позиция начала буфера в файле
+        self.offset = 0
+        self.eof = False
+
+    def fill(self, min_unread=0):
+        # Дочитывает хотя бы один кусок и дальше, пока непрочитанная часть буфера короче min_unread.
+        # Куски склеиваются с буфером один раз, прочитанную часть буфера отбрасываем
+        chunks = []
+        unread = len(self.buffer) - self.pos
+        while not chunks or unread < min_unread:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk)
+            unread += len(chunk)
+        if not chunks:
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + ''.join(chunks)
+        self.pos = 0
+        return True
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def peek(self):
+        # Следующий значащий символ, пустая строка в конце файла
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'Expected {char!r} at position {self.tell()}, found {found!r}')
+        self.pos += 1
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+                # Число на краю буфера может продолжаться в следующем куске, в том числе после точки или экспоненты
+                if self.eof or end < len(self.buffer) and self.buffer[end] not in NUMBER_CHARS:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as error:
+                if self.eof:
+                    # Позиция ошибки в файле, а не в буфере
+                    raise ValueError(f'{error.msg} at position {self.offset + error.pos}') from error
+            # Разбор повторяем, когда непрочитанная часть буфера вырастет вдвое, иначе большой объект
+            # разбирался бы заново после каждого куска
+            self.fill(2 * (len(self.buffer) - self.pos))
+
+
+def iter_geojson_features(file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yields the features of a GeoJSON FeatureCollection one by one while reading the file incrementally.
+    Other members of the collection are parsed and skipped.
+    """
+    stream = JsonStream(file, chunk_size)
+    stream.expect('{')
+    if stream.skip('}'):
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'features':
+            stream.expect('[')
+            if not stream.skip(']'):
+                while True:
+                    yield stream.value()
+                    if not stream.skip(','):
+                        stream.expect(']')
+                        break
+        else:
+            stream.value()
+        if not stream.skip(','):
+            stream.expect('}')
+            return
+
+
+def find_features_start(file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Position right after the opening bracket of the features array of a GeoJSON FeatureCollection,
+    None when the collection has no features. Members before the array are parsed and skipped.
+    """
+    stream = JsonStream(file, chunk_size)
+    stream.expect('{')
+    if stream.skip('}'):
+        return None
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'features':
+            stream.expect('[')
+            return None if stream.skip(']') else stream.tell()
+        stream.value()
+        if not stream.skip(','):
+            stream.expect('}')
+            return None
+
+
+def iter_json_values(file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yields comma separated JSON values up to the end of the file: a slice of the features array
+    cut at feature boundaries.
+    """
+    stream = JsonStream(file, chunk_size)
+    while stream.peek():
+        yield stream.value()
+        stream.skip(',')
@@ -0,0 +1,238 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+GRID_CRS = 'EPSG:3857'
+CACHE_FORMAT = 1
+
+# Сетки, уже загруженные в этом процессе: путь к источнику -> (сигнатура файла, GeoDataFrame)
+_loaded_grids = {}
+# Блокировки каталогов кэша, которые держит текущий поток
+_held_locks = threading.local()
+
+
+def get_grid_cache_dir():
+    return os.path.join(settings.SCORING_CACHE_DIR, 'grid')
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('format') == CACHE_FORMAT else None
+
+
+def write_manifest(cache_dir, manifest):
+    tmp_path = os.path.join(cache_dir, 'manifest.json.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, os.path.join(cache_dir, 'manifest.json'))
+
+
+@contextmanager
+def cache_lock(cache_dir):
+    """
+    Exclusive lock of a cache directory between processes and threads, taken around build and replacement.
+    Reentrant within a thread, the lock file lies next to the directory and survives its replacement.
+    """
+    path = os.path.abspath(cache_dir) + '.lock'
+    held = _held_locks.__dict__.setdefault('paths', set())
+    if path in held:
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        held.add(path)
+        try:
+            yield
+        finally:
+            held.discard(path)
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def replace_cache_dir(tmp_dir, cache_dir):
+    # Подменяем старый кэш целиком, уже открытые через mmap файлы остаются доступны читателям
+    with cache_lock(cache_dir):
+        if os.path.exists(cache_dir):
+            old_dir = tempfile.mkdtemp(prefix='.old-', dir=os.path.dirname(cache_dir))
+            os.replace(cache_dir, os.path.join(old_dir, 'cache'))
+            os.replace(tmp_dir, cache_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, cache_dir)
+
+
+def build_grid_cache(source_path, cache_dir=None):
+    """
+    Converts the source grid into the cache: EPSG:3857 geometry as ragged coordinate arrays,
+    precomputed centroids and attribute columns, each stored as a separate .npy file.
+    """
+    cache_dir = cache_dir or get_grid_cache_dir()
+    with cache_lock(cache_dir):
+        return _build_grid_cache(source_path, cache_dir)
+
+
+def _build_grid_cache(source_path, cache_dir):
+    signature = file_signature(source_path)
+    sha256 = file_sha256(source_path)
+
+    grid = gpd.read_file(source_path).to_crs(GRID_CRS)
+    centroids = shapely.get_coordinates(grid.geometry.centroid.to_numpy())
+    grid['centroid_x'] = centroids[:, 0]
+    grid['centroid_y'] = centroids[:, 1]
+
+    parent_dir = os.path.dirname(cache_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.grid-', dir=parent_dir)
+
+    geom_type, coords, offsets = shapely.to_ragged_array(grid.geometry.to_numpy())
+    np.save(os.path.join(tmp_dir, 'coords.npy'), coords)
+    for i, offset in enumerate(offsets):
+        np.save(os.path.join(tmp_dir, f'offsets_{i}.npy'), offset)
+
+    columns = {}
+    for column in grid.columns.drop(grid.geometry.name):
+        values = grid[column]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), values.to_numpy())
+            columns[column] = None
+        else:
+            codes, categories = pd.factorize(values)
+            np.save(os.path.join(tmp_dir, f'{column}.npy'), codes.astype(np.int32))
+            columns[column] = [str(category) for category in categories]
+
+    write_manifest(tmp_dir, {
+        'format': CACHE_FORMAT,
+        'source': os.path.abspath(source_path),
+        'signature': signature,
+        'sha256': sha256,
+        'crs': GRID_CRS,
+        'count': len(grid),
+        'geom_type': int(geom_type),
+        'offsets': len(offsets),
+        'columns': columns,
+    })
+
+    replace_cache_dir(tmp_dir, cache_dir)
+
+    logger.info('Grid cache built: %s cells from %s', len(grid), source_path)
+    return read_manifest(cache_dir)
+
+
+def load_grid_cache(cache_dir, manifest):
+    def load(name):
+        return np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r')
+
+    geometry = shapely.from_ragged_array(
+        shapely.GeometryType(manifest['geom_type']),
+        load('coords'),
+        tuple(load(f'offsets_{i}') for i in range(manifest['offsets'])),
+    )
+
+    data = {}
+    for column, categories in manifest['columns'].items():
+        values = load(column)
+        if categories is None:
+            data[column] = values
+        else:
+            # Код -1 (пустое значение) попадает на последний элемент - None
+            data[column] = np.asarray(categories + [None], dtype=object)[values]
+
+    return gpd.GeoDataFrame(data, geometry=geometry, crs=manifest['crs'])
+
+
+def is_grid_cache_current(manifest, source_path, signature):
+    return manifest is not None and manifest['source'] == os.path.abspath(source_path) and \
+        manifest['signature'] == signature
+
+
+def ensure_grid_cache(source_path, cache_dir=None):
+    """
+    Returns an up-to-date cache manifest for the source grid, rebuilding the cache when the
+    source file content has changed. Only one process rebuilds, the others wait for it and reuse the result.
+    """
+    cache_dir = cache_dir or get_grid_cache_dir()
+    signature = file_signature(source_path)
+    manifest = read_manifest(cache_dir)
+    if is_grid_cache_current(manifest, source_path, signature):
+        return manifest
+
+    with cache_lock(cache_dir):
+        # Пока ждали блокировку, кэш мог пересобрать другой процесс
+        manifest = read_manifest(cache_dir)
+        if manifest is None or manifest['source'] != os.path.abspath(source_path):
+            return _build_grid_cache(source_path, cache_dir)
+
+        if manifest['signature'] != signature:
+            # Файл трогали - пересобираем только если изменилось содержимое
+            if file_sha256(source_path) != manifest['sha256']:
+                return _build_grid_cache(source_path, cache_dir)
+            manifest['signature'] = signature
+            write_manifest(cache_dir, manifest)
+
+    return manifest
+
+
+def get_grid(source_path):
+    """
+    Returns the scoring grid, loaded once per process and shared read-only between tasks.
+    Callers must not modify the returned frame in place, use a shallow copy instead.
+    """
+    signature = file_signature(source_path)
+    loaded = _loaded_grids.get(source_path)
+    if loaded is not None and loaded[0] == signature:
+        return loaded[1]
+
+    cache_dir = get_grid_cache_dir()
+    manifest = ensure_grid_cache(source_path, cache_dir)
+    grid = load_grid_cache(cache_dir, manifest)
+    _loaded_grids[source_path] = (signature, grid)
+    return grid
+
+
+def get_centroid_coords(grid):
+    # В кэшированной сетке центроиды уже посчитаны
+    if 'centroid_x' in grid:
+        return np.column_stack([grid['centroid_x'].to_numpy(), grid['centroid_y'].to_numpy()])
+    return shapely.get_coordinates(grid.geometry.centroid.to_numpy())
+
+
+def get_grid_version(source_path):
+    manifest = read_manifest(get_grid_cache_dir())
+    if manifest is None or manifest['source'] != os.path.abspath(source_path):
+        return None
+    # Файл сетки трогали после сборки кэша - версия станет известна после проверки содержимого
+    if manifest['signature'] != file_signature(source_path):
+        return None
+    return manifest['sha256']
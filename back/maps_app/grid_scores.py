@@ -0,0 +1,123 @@
+import io
+
+import numpy as np
+from django.db import connection, transaction
+
+from maps_app.models import Feature, GridCell, MapLayer, ScoringCellScore
+
+GRID_SCORES_STORAGE = 'grid_scores'
+# Ключ блокировки загрузки ячеек: одну сетку не дописывают две задачи одновременно
+GRID_CELLS_LOCK_ID = 0x5c0e3
+# Ячейки H3 уникальны глобально, поэтому у всех разрешений одна версия
+H3_GRID_VERSION = 'h3'
+
+
+def get_cell_ids(grid):
+    # Ячейка основной сетки определяется меткой строки в кэше сетки, ячейка H3 - своим индексом
+    if 'h3_index' in grid:
+        return grid['h3_index'].to_numpy(dtype=np.int64)
+    return grid.index.to_numpy(dtype=np.int64)
+
+
+def lock_grid_cells(cursor):
+    # Вызывается в транзакции, блокировка снимается вместе с ней
+    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [GRID_CELLS_LOCK_ID])
+
+
+def get_missing_cells(cursor, grid_version, cell_ids):
+    """
+    Boolean mask of the cells that are not stored in the shared grid table yet.
+    """
+    cursor.execute(
+        f'SELECT cell_id FROM {GridCell._meta.db_table} WHERE grid_version = %s AND cell_id = ANY(%s)',
+        [grid_version, cell_ids.tolist()]
+    )
+    existing = np.fromiter((row[0] for row in cursor.fetchall()), dtype=np.int64)
+    return ~np.isin(cell_ids, existing)
+
+
+def copy_grid_cells(cursor, grid_version, cell_ids, geometries):
+    # Геометрии приходят уже в EWKB
+    buffer = io.StringIO()
+    for cell_id, geometry in zip(cell_ids.tolist(), geometries):
+        buffer.write(f'{grid_version}\t{cell_id}\t{geometry}\n')
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY {GridCell._meta.db_table} (grid_version, cell_id, geometry) FROM STDIN', buffer)
+
+
+def delete_outdated_grid_cells(current_versions):
+    """
+    Deletes the shared cells of grid versions that no layer references, except `current_versions`.
+    Returns the number of deleted cells.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Под той же блокировкой задача записывает ячейки и привязывает к ним слой
+        lock_grid_cells(cursor)
+        referenced = MapLayer.objects.filter(storage=GRID_SCORES_STORAGE, grid_version__isnull=False) \
+            .values_list('grid_version', flat=True)
+        kept = set(referenced) | set(current_versions)
+        deleted, _ = GridCell.objects.exclude(grid_version__in=kept).delete()
+    return deleted
+
+
+def copy_cell_scores(cursor, layer_id, cell_ids, scores, poi_scores):
+    """
+    Writes (cell, score, per-category scores) rows of a layer with COPY.
+    poi_scores is a (cells, categories) array in the order of the layer's score_fields.
+    """
+    buffer = io.StringIO()
+    for cell_id, score, cell_poi_scores in zip(cell_ids.tolist(), scores.tolist(), poi_scores.tolist()):
+        array = ','.join(map(repr, cell_poi_scores))
+        buffer.write(f'{layer_id}\t{cell_id}\t{score!r}\t{{{array}}}\n')
+    buffer.seek(0)
+    cursor.copy_expert(
+        f'COPY {ScoringCellScore._meta.db_table} (map_layer_id, cell_id, score, poi_scores) FROM STDIN', buffer
+    )
+
+
+def copy_layer_cell_scores(cursor, source_layer_id, layer_id):
+    table = ScoringCellScore._meta.db_table
+    cursor.execute(
+        f'INSERT INTO {table} (map_layer_id, cell_id, score, poi_scores) '
+        f'SELECT %s, cell_id, score, poi_scores FROM {table} WHERE map_layer_id = %s ORDER BY cell_id',
+        [layer_id, source_layer_id]
+    )
+    return cursor.rowcount
+
+
+def get_cell_properties(cell_score, score_fields):
+    # Свойства ячейки в том же виде, что и у объектов слоя
+    return {'score': cell_score.score, **dict(zip(score_fields, cell_score.poi_scores))}
+
+
+def get_layer_sample_properties(map_layer):
+    """
+    Properties of the first object of a layer, None for an empty layer.
+    """
+    if map_layer.storage == GRID_SCORES_STORAGE:
+        cell_score = map_layer.cell_scores.order_by('id').first()
+        return get_cell_properties(cell_score, map_layer.score_fields) if cell_score else None
+    feature = Feature.objects.filter(map_layer=map_layer).first()
+    return feature.properties if feature else None
+
+
+def get_layer_property_lookup(map_layer, property_name):
+    """
+    Queryset of the layer objects and the lookup of a property in it: a key of the JSON properties
+    of features or a typed column of cell scores.
+    """
+    if map_layer.storage != GRID_SCORES_STORAGE:
+        return Feature.objects.filter(map_layer=map_layer), f'properties__{property_name}'
+    cell_scores = ScoringCellScore.objects.filter(map_layer=map_layer)
+    if property_name == 'score':
+        return cell_scores, 'score'
+    if property_name in map_layer.score_fields:
+        # Индексы ArrayField в ORM начинаются с нуля
+        return cell_scores, f'poi_scores__{map_layer.score_fields.index(property_name)}'
+    return cell_scores.none(), 'score'
+
+
+def count_layer_objects(map_layer):
+    if map_layer.storage == GRID_SCORES_STORAGE:
+        return map_layer.cell_scores.count()
+    return map_layer.features.count()
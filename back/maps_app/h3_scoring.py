@@ -0,0 +1,236 @@
+import logging
+import os
+import tempfile
+from itertools import chain
+from math import ceil
+
+import numpy as np
+import pandas as pd
+import shapely
+from django.conf import settings
+from h3.api import basic_int as h3
+from pyproj import Transformer
+
+from maps_app.grid_cache import GRID_CRS, CACHE_FORMAT, cache_lock, get_grid, get_grid_version, read_manifest, \
+    write_manifest, replace_cache_dir
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6378137
+# Ячейки одного разрешения H3 различаются по размеру, кольца берём с запасом на самые мелкие и крупные из них
+MIN_EDGE_RATIO = 0.7
+MAX_EDGE_RATIO = 1.4
+# Сколько точек обрабатывается за раз: каждая точка даёт столько пар, сколько ячеек в её кольце
+POINTS_CHUNK_SIZE = 100000
+
+# Сетки H3 и разбиение точек по ячейкам, уже посчитанные в этом процессе
+_loaded_h3_grids = {}
+_poi_buckets = {}
+
+
+def get_h3_grid_dir(resolution):
+    grid_version = get_grid_version(settings.SCORING_GRID_PATH)
+    return os.path.join(settings.SCORING_CACHE_DIR, 'h3', f'{grid_version[:16]}-{resolution}')
+
+
+def to_lonlat(x, y):
+    return Transformer.from_crs(GRID_CRS, 'EPSG:4326', always_xy=True).transform(x, y)
+
+
+def build_h3_grid(resolution, grid_dir):
+    """
+    Covers the cities of the scoring grid with H3 cells of the given resolution.
+    Cells are sorted by index, centers are stored in the grid CRS.
+    """
+    grid = get_grid(settings.SCORING_GRID_PATH)
+    codes, cities = pd.factorize(grid['city_name'])
+    geometries = grid.geometry.to_numpy()
+
+    cells, city_codes = [], []
+    for code in range(-1, len(cities)):
+        mask = codes == code
+        if not mask.any():
+            continue
+        # Ячейки сетки города не перекрываются, их объединение - покрытие
+        area = shapely.transform(shapely.coverage_union_all(geometries[mask]),
+                                 lambda coords: np.column_stack(to_lonlat(coords[:, 0], coords[:, 1])))
+        for polygon in shapely.get_parts(area):
+            if not isinstance(polygon, shapely.Polygon) or polygon.is_empty:
+                continue
+            city_cells = h3.polyfill(shapely.geometry.mapping(polygon), resolution, geo_json_conformant=True)
+            cells.extend(city_cells)
+            city_codes.extend([code] * len(city_cells))
+
+    # Ячейка на границе двух городов достаётся первому
+    cells, first = np.unique(np.array(cells, dtype=np.int64), return_index=True)
+    city_codes = np.array(city_codes, dtype=np.int32)[first]
+
+    centers = np.array([h3.h3_to_geo(cell) for cell in cells.tolist()], dtype=np.float64).reshape(-1, 2)
+    centroid_x, centroid_y = Transformer.from_crs('EPSG:4326', GRID_CRS, always_xy=True).transform(centers[:, 1],
+                                                                                                   centers[:, 0])
+
+    os.makedirs(os.path.dirname(grid_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.h3-', dir=os.path.dirname(grid_dir))
+    np.save(os.path.join(tmp_dir, 'h3_index.npy'), cells)
+    np.save(os.path.join(tmp_dir, 'city_name.npy'), city_codes)
+    np.save(os.path.join(tmp_dir, 'centroid_x.npy'), np.asarray(centroid_x, dtype=np.float64))
+    np.save(os.path.join(tmp_dir, 'centroid_y.npy'), np.asarray(centroid_y, dtype=np.float64))
+    write_manifest(tmp_dir, {
+        'format': CACHE_FORMAT,
+        'resolution': resolution,
+        'count': len(cells),
+        'cities': [str(city) for city in cities],
+    })
+    replace_cache_dir(tmp_dir, grid_dir)
+
+    logger.info('H3 grid built: resolution %s, %s cells', resolution, len(cells))
+    return read_manifest(grid_dir)
+
+
+def get_h3_grid(resolution):
+    """
+    Returns the H3 grid of a resolution: h3_index, city_name and cell centers, without geometry.
+    Built once per version of the scoring grid and shared read-only between tasks.
+    """
+    get_grid(settings.SCORING_GRID_PATH)
+    grid_dir = get_h3_grid_dir(resolution)
+    loaded = _loaded_h3_grids.get(grid_dir)
+    if loaded is not None:
+        return loaded
+
+    manifest = read_manifest(grid_dir)
+    if manifest is None:
+        with cache_lock(grid_dir):
+            # Сетку мог построить другой процесс, пока ждали блокировку
+            manifest = read_manifest(grid_dir) or build_h3_grid(resolution, grid_dir)
+
+    def load(name):
+        return np.load(os.path.join(grid_dir, f'{name}.npy'), mmap_mode='r')
+
+    grid = pd.DataFrame({
+        'h3_index': load('h3_index'),
+        # Код -1 (пустое значение) попадает на последний элемент - None
+        'city_name': np.asarray(manifest['cities'] + [None], dtype=object)[load('city_name')],
+        'centroid_x': load('centroid_x'),
+        'centroid_y': load('centroid_y'),
+    })
+    _loaded_h3_grids[grid_dir] = grid
+    return grid
+
+
+def get_cells_resolution(cells):
+    return h3.h3_get_resolution(int(cells[0])) if len(cells) else 0
+
+
+class PoiBuckets:
+    """
+    Points of a POI snapshot bucketed into H3 cells: unique cells and the cell of every point.
+    """
+
+    def __init__(self, cells, inverse, coords):
+        self.cells = cells
+        self.inverse = inverse
+        self.coords = coords
+
+
+def get_poi_buckets(snapshot, resolution):
+    key = (snapshot.table, snapshot.version, resolution)
+    buckets = _poi_buckets.get(key)
+    if buckets is not None:
+        return buckets
+
+    # Для линий и полигонов берём центроид, расстояния в этом режиме считаются между центрами
+    coords = shapely.get_coordinates(shapely.centroid(snapshot.geometries)).reshape(-1, 2)
+    lon, lat = to_lonlat(coords[:, 0], coords[:, 1])
+    point_cells = np.fromiter((h3.geo_to_h3(y, x, resolution) for x, y in zip(lon.tolist(), lat.tolist())),
+                              dtype=np.int64, count=len(coords))
+    cells, inverse = np.unique(point_cells, return_inverse=True)
+
+    buckets = PoiBuckets(cells, inverse.reshape(-1), coords)
+    _poi_buckets[key] = buckets
+    return buckets
+
+
+def clip_poi_buckets(buckets, bounds, radius):
+    """
+    Keeps the points within radius of the grid extent and only the cells they fall into.
+    """
+    if bounds is None:
+        return PoiBuckets(buckets.cells[:0], buckets.inverse[:0], buckets.coords[:0])
+    xmin, ymin, xmax, ymax = bounds
+    coords = buckets.coords
+    keep = ((coords[:, 0] >= xmin - radius) & (coords[:, 0] <= xmax + radius) &
+            (coords[:, 1] >= ymin - radius) & (coords[:, 1] <= ymax + radius))
+    if keep.all():
+        return buckets
+    # Кольца считаются по ячейкам с точками, ячейки без оставшихся точек отбрасываем
+    used, inverse = np.unique(buckets.inverse[keep], return_inverse=True)
+    return PoiBuckets(buckets.cells[used], inverse.reshape(-1), coords[keep])
+
+
+def get_ring_size(resolution, radius, centroid_y):
+    """
+    Number of k-rings around a point's cell that contains every cell center within radius (grid CRS units).
+    """
+    # Расстояние в EPSG:3857 больше реального в 1/cos(широта) раз, запас берём по широте, ближайшей к экватору
+    scale = 1 / np.cosh(np.abs(centroid_y).min(initial=np.inf) / EARTH_RADIUS) if len(centroid_y) else 1
+    edge = h3.edge_length(resolution, unit='m')
+    # Центры ячеек k-го кольца не ближе 1.5 * k ребра к центру, а точка не дальше ребра от центра своей ячейки
+    return int(ceil((radius * scale + edge * MAX_EDGE_RATIO) / (1.5 * edge * MIN_EDGE_RATIO)))
+
+
+def iter_h3_neighbors(grid_cells, centroids, buckets, radius):
+    """
+    Yields (cell index, distance) chunks of every grid cell whose center lies within radius of a point.
+    Candidates come from k-rings of the points' cells looked up by integer cell id.
+    """
+    if not len(grid_cells) or not len(buckets.cells):
+        return
+
+    k = get_ring_size(get_cells_resolution(grid_cells), radius, centroids[:, 1])
+
+    # Кольцо считается один раз на ячейку с точками, оставляем только ячейки, которые есть в сетке
+    rings = [np.fromiter(h3.k_ring(cell, k), dtype=np.int64) for cell in buckets.cells.tolist()]
+    lengths = np.fromiter(map(len, rings), dtype=np.int64, count=len(rings))
+    ring_cells = np.concatenate(rings)
+    ring_ids = np.repeat(np.arange(len(rings)), lengths)
+    positions = np.searchsorted(grid_cells, ring_cells).clip(max=len(grid_cells) - 1)
+    found = grid_cells[positions] == ring_cells
+    positions, ring_ids = positions[found], ring_ids[found]
+    lengths = np.bincount(ring_ids, minlength=len(rings))
+    offsets = np.cumsum(lengths) - lengths
+
+    for start in range(0, len(buckets.inverse), POINTS_CHUNK_SIZE):
+        inverse = buckets.inverse[start:start + POINTS_CHUNK_SIZE]
+        coords = buckets.coords[start:start + POINTS_CHUNK_SIZE]
+
+        # Каждая точка образует пару со всеми ячейками кольца своей ячейки
+        point_lengths = lengths[inverse]
+        point_idx = np.repeat(np.arange(len(inverse)), point_lengths)
+        within = np.arange(point_lengths.sum()) - np.repeat(np.cumsum(point_lengths) - point_lengths, point_lengths)
+        cell_idx = positions[np.repeat(offsets[inverse], point_lengths) + within]
+
+        distances = np.hypot(centroids[cell_idx, 0] - coords[point_idx, 0],
+                             centroids[cell_idx, 1] - coords[point_idx, 1])
+        keep = distances <= radius
+        yield cell_idx[keep], distances[keep]
+
+
+def h3_cell_boundaries(cells):
+    """
+    EPSG:4326 boundary rings of H3 cells as ragged arrays: closed ring coordinates and ring offsets.
+    """
+    boundaries = [h3.h3_to_geo_boundary(cell, geo_json=True) for cell in np.asarray(cells).tolist()]
+    ring_lengths = np.fromiter(map(len, boundaries), dtype=np.int64, count=len(boundaries))
+    coords = np.fromiter(chain.from_iterable(chain.from_iterable(boundaries)), dtype=np.float64,
+                         count=2 * int(ring_lengths.sum())).reshape(-1, 2)
+    return coords, np.concatenate([[0], np.cumsum(ring_lengths)])
+
+
+def h3_cell_polygons(cells):
+    """
+    Builds EPSG:4326 hexagons of H3 cells, used only when the grid is exported.
+    """
+    coords, ring_offsets = h3_cell_boundaries(cells)
+    polygon_offsets = np.arange(len(ring_offsets))
+    return shapely.from_ragged_array(shapely.GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
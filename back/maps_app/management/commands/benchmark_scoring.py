@@ -0,0 +1,259 @@
+import io
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from maps_app.grid_cache import GRID_CRS
+from maps_app.metrics import TransientTask, MemoryPeak, get_stages_peak_rss_mb
+from maps_app.models import MapLayer
+from maps_app.poi_snapshots import create_osm_engine, write_poi_snapshot
+from maps_app.regions import clip_grid_to_region
+from maps_app.sql_scoring import get_sql_grid_table
+from maps_app.utils import SCORING_BACKENDS, SCORE_NORMALIZATIONS, setup_grid, setup_h3_grid, \
+    export_scoring_features
+from users_app.models import User
+
+POI_PARAMS = [
+    {'max-score': 7, 'max-distance': 300},
+    {'max-score': 16, 'max-distance': 500},
+    {'max-score': 9, 'max-distance': 800},
+    {'max-score': 21, 'max-distance': 1000},
+]
+
+
+def make_synthetic_grid(cells, cities, cell_size):
+    """
+    Square cells in EPSG:3857 split into equal square cities placed apart from each other.
+    """
+    cells_per_city = -(-cells // cities)
+    side = int(np.ceil(np.sqrt(cells_per_city)))
+    city_span = side * cell_size + 10000
+
+    index = np.arange(cells)
+    city = index // cells_per_city
+    position = index % cells_per_city
+    xmin = city * city_span + (position % side) * cell_size
+    ymin = (position // side) * cell_size
+
+    geometry = shapely.box(xmin, ymin, xmin + cell_size, ymin + cell_size)
+    return gpd.GeoDataFrame({'city_name': [f'city_{i}' for i in city]}, geometry=geometry, crs=GRID_CRS)
+
+
+def make_synthetic_poi(grid, count, rng):
+    # Точки равномерно разбросаны по городам с запасом в километр вокруг
+    bounds = grid.geometry.bounds.groupby(grid['city_name']).agg({'minx': 'min', 'miny': 'min',
+                                                                  'maxx': 'max', 'maxy': 'max'})
+    city = rng.integers(0, len(bounds), count)
+    x = rng.uniform(bounds['minx'].to_numpy()[city] - 1000, bounds['maxx'].to_numpy()[city] + 1000)
+    y = rng.uniform(bounds['miny'].to_numpy()[city] - 1000, bounds['maxy'].to_numpy()[city] + 1000)
+    return shapely.points(x, y)
+
+
+def create_poi_tables(engine, poi_geometries):
+    # Для движка sql точки нужны в самой базе OSM
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            for poi, geometries in poi_geometries.items():
+                cursor.execute(f'DROP TABLE IF EXISTS {poi}')
+                cursor.execute(f'CREATE TABLE {poi} (geom geometry(Point, 3857))')
+                buffer = io.StringIO('\n'.join(shapely.to_wkb(shapely.set_srid(geometries, 3857), hex=True,
+                                                              include_srid=True)) + '\n')
+                cursor.copy_expert(f'COPY {poi} (geom) FROM STDIN', buffer)
+                cursor.execute(f'CREATE INDEX ON {poi} USING gist (geom)')
+                cursor.execute(f'ANALYZE {poi}')
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def drop_benchmark_tables(engine, tables):
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            for table in tables:
+                cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks scoring stages on a synthetic grid and checks backends against the reference implementation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cells', type=int, default=100000, help='Number of grid cells')
+        parser.add_argument('--cities', type=int, default=4, help='Number of cities the grid is split into')
+        parser.add_argument('--cell-size', type=float, default=100, help='Cell side in meters')
+        parser.add_argument('--poi-categories', type=int, default=4, help='Number of POI categories')
+        parser.add_argument('--poi-points', type=int, default=20000, help='Number of points in each category')
+        parser.add_argument('--polygon-radius', type=int, default=50)
+        parser.add_argument('--h3-resolution', type=int, default=settings.SCORING_H3_RESOLUTION,
+                            help='Resolution of the H3 grid for the h3 backend')
+        parser.add_argument('--backends', default='vectorized,parallel',
+                            help=f'Comma separated backends: {", ".join(SCORING_BACKENDS)}')
+        parser.add_argument('--check-cells', type=int, default=2000,
+                            help='Grid size of the correctness check against the reference backend, 0 to skip')
+        parser.add_argument('--export', action='store_true',
+                            help='Also benchmark the export into maps_app_feature (needs the PostGIS database)')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        backends = [backend for backend in options['backends'].split(',') if backend]
+        unknown = set(backends) - set(SCORING_BACKENDS)
+        if unknown:
+            raise CommandError(f'Unknown backends: {", ".join(sorted(unknown))}')
+
+        self.results = []
+        self.sql_tables = []
+        rng = np.random.default_rng(options['seed'])
+        poi_list = {
+            f'benchmark_poi_{i}': POI_PARAMS[i % len(POI_PARAMS)]
+            for i in range(options['poi_categories'])
+        }
+
+        with tempfile.TemporaryDirectory(prefix='scoring-benchmark-') as tmp_dir:
+            grid_path = os.path.join(tmp_dir, 'grid.gpkg')
+            # Кэш первичных баллов отключён, иначе движки брали бы результаты друг у друга
+            with override_settings(SCORING_CACHE_DIR=os.path.join(tmp_dir, 'cache'), SCORING_GRID_PATH=grid_path,
+                                   SCORING_PRIMARY_CACHE=False):
+                grid = make_synthetic_grid(options['cells'], options['cities'], options['cell_size'])
+                poi_geometries = {poi: make_synthetic_poi(grid, options['poi_points'], rng) for poi in poi_list}
+                for poi, geometries in poi_geometries.items():
+                    write_poi_snapshot(poi, f'synthetic-{options["seed"]}', geometries)
+
+                engine = create_osm_engine()
+                if 'sql' in backends:
+                    create_poi_tables(engine, poi_geometries)
+                try:
+                    if options['check_cells']:
+                        self.check_backends(backends, poi_list, poi_geometries, options, tmp_dir, engine)
+                    self.benchmark(grid, grid_path, backends, poi_list, options, engine)
+                finally:
+                    if 'sql' in backends:
+                        drop_benchmark_tables(engine, list(poi_list) + self.sql_tables)
+
+        self.report()
+
+    def benchmark(self, grid, grid_path, backends, poi_list, options, engine):
+        grid.to_file(grid_path)
+        cells = len(grid)
+
+        with self.stage('grid cache build + load', cells):
+            setup_grid(grid_path)
+        with self.stage('grid load (warm)', cells):
+            setup_grid(grid_path)
+
+        scored = None
+        for backend in backends:
+            if backend == 'h3':
+                scoring_grid = setup_h3_grid(options['h3_resolution'])
+                with self.stage(f'scoring: h3 ({len(scoring_grid)} cells)', len(scoring_grid)) as task:
+                    SCORING_BACKENDS[backend](engine, scoring_grid, poi_list, options['polygon_radius'], task)
+                continue
+
+            scoring_grid = setup_grid(grid_path)
+            with self.stage(f'scoring: {backend}', cells) as task:
+                scored = SCORING_BACKENDS[backend](engine, scoring_grid, poi_list, options['polygon_radius'], task)
+            if backend == 'sql':
+                self.sql_tables.append(get_sql_grid_table())
+
+        if scored is None:
+            return
+
+        if 'vectorized' in backends:
+            # Повторный расчет с другими макс. баллами: первичные баллы берутся из кэша
+            reweighted = {poi: {**params, 'max-score': params['max-score'] + 1} for poi, params in poi_list.items()}
+            with override_settings(SCORING_PRIMARY_CACHE=True):
+                SCORING_BACKENDS['vectorized'](engine, setup_grid(grid_path), poi_list, options['polygon_radius'],
+                                               TransientTask())
+                with self.stage('scoring: reweighted, cached', cells) as task:
+                    SCORING_BACKENDS['vectorized'](engine, setup_grid(grid_path), reweighted,
+                                                   options['polygon_radius'], task)
+
+            # Расчет по области интереса из одного города: сетка и точки обрезаются до расчета
+            region_grid = clip_grid_to_region(setup_grid(grid_path), {'cities': ['city_0']})
+            with self.stage('scoring: vectorized, one city', len(region_grid)) as task:
+                SCORING_BACKENDS['vectorized'](engine, region_grid, poi_list, options['polygon_radius'], task)
+
+        for normalization, normalize in SCORE_NORMALIZATIONS.items():
+            normalized = scored.copy(deep=False)
+            with self.stage(f'normalization: {normalization}', cells):
+                normalize(normalized)
+
+        if options['export']:
+            creator = User.objects.filter(is_superuser=True).first()
+            layer = MapLayer.objects.create(name='Scoring benchmark', creator=creator)
+            try:
+                with self.stage('export', cells) as task:
+                    export_scoring_features(layer.id, scored, task)
+            finally:
+                layer.delete()
+
+    def check_backends(self, backends, poi_list, poi_geometries, options, tmp_dir, engine):
+        """
+        Scores a small grid with the reference implementation and every backend, scores must match.
+        """
+        check_grid_path = os.path.join(tmp_dir, 'check_grid.gpkg')
+        make_synthetic_grid(options['check_cells'], options['cities'], options['cell_size']).to_file(check_grid_path)
+
+        with override_settings(SCORING_GRID_PATH=check_grid_path):
+            reference = SCORING_BACKENDS['reference'](engine, setup_grid(check_grid_path), poi_list,
+                                                      options['polygon_radius'], TransientTask())
+            failed = []
+            for backend in backends:
+                if backend == 'h3':
+                    # Сетка H3 не совпадает с исходной, сравнивать не с чем
+                    self.stdout.write('check h3: skipped, scores are computed on a different grid')
+                    continue
+                result = SCORING_BACKENDS[backend](engine, setup_grid(check_grid_path), poi_list,
+                                                   options['polygon_radius'], TransientTask())
+                if backend == 'sql':
+                    self.sql_tables.append(get_sql_grid_table())
+                if backend == 'fft':
+                    # Приближенный движок с эталоном не совпадает, сообщаем его погрешность
+                    error = np.abs(result['score'].to_numpy(dtype=np.float64) -
+                                   reference['score'].to_numpy(dtype=np.float64))
+                    self.stdout.write(f'check fft: approximate, score error max {error.max(initial=0):.3g}, '
+                                      f'mean {error.mean() if len(error) else 0:.3g}, '
+                                      f'p95 {np.percentile(error, 95) if len(error) else 0:.3g}')
+                    continue
+                columns = ['score'] + [poi for poi in poi_list if poi in result]
+                difference = max(
+                    np.abs(result[column].to_numpy(dtype=np.float64) - reference[column].to_numpy(dtype=np.float64))
+                    .max(initial=0)
+                    for column in columns
+                )
+                # Экономный движок хранит баллы в float32
+                matches = difference <= (1e-3 if backend == 'low_memory' else 1e-6)
+                self.stdout.write(f'check {backend}: max abs difference {difference:.3g} '
+                                  f'({"ok" if matches else "MISMATCH"})')
+                if not matches:
+                    failed.append(backend)
+
+        if failed:
+            raise CommandError(f'Backends do not match the reference implementation: {", ".join(failed)}')
+
+    @contextmanager
+    def stage(self, name, cells):
+        # Движки пишут метрики этапов в задачу, этапы процессов пула учитываются в пике памяти
+        task = TransientTask()
+        start = time.perf_counter()
+        with MemoryPeak() as memory:
+            yield task
+        elapsed = time.perf_counter() - start
+        peak_rss = max(memory.peak_mb, get_stages_peak_rss_mb(task.metrics))
+        self.results.append((name, elapsed, peak_rss, memory.delta_mb, cells / elapsed if elapsed else float('inf')))
+
+    def report(self):
+        self.stdout.write(f'{"stage":<32}{"wall, s":>12}{"peak RSS, MB":>16}{"RSS delta, MB":>16}{"cells/s":>16}')
+        for name, elapsed, peak_rss, rss_delta, speed in self.results:
+            self.stdout.write(f'{name:<32}{elapsed:>12.3f}{peak_rss:>16.1f}{rss_delta:>16.1f}{speed:>16.0f}')
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from maps_app.grid_cache import build_grid_cache, ensure_grid_cache
+
+
+class Command(BaseCommand):
+    help = 'Builds the scoring grid cache from the source grid file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.SCORING_GRID_PATH, help='Path to the source grid file')
+        parser.add_argument('--force', action='store_true', help='Rebuild the cache even if it is up to date')
+
+    def handle(self, *args, **options):
+        if options['force']:
+            manifest = build_grid_cache(options['path'])
+        else:
+            manifest = ensure_grid_cache(options['path'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Grid cache is up to date: {manifest['count']} cells, sha256 {manifest['sha256']}"
+        ))
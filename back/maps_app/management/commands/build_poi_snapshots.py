@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from maps_app.models import POIConfig
+from maps_app.poi_snapshots import create_osm_engine, refresh_poi_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Builds or refreshes local snapshots of the OSM POI tables used in scoring'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tables', nargs='*', help='POI tables, all configured POI by default')
+        parser.add_argument('--force', action='store_true', help='Rebuild snapshots even if they are up to date')
+
+    def handle(self, *args, **options):
+        tables = options['tables'] or list(POIConfig.objects.values_list('name', flat=True))
+        engine = create_osm_engine()
+
+        for table in tables:
+            try:
+                if refresh_poi_snapshot(engine, table, force=options['force']):
+                    self.stdout.write(self.style.SUCCESS(f'Snapshot refreshed: {table}'))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'Snapshot is up to date: {table}'))
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'Error refreshing snapshot {table}: {e}'))
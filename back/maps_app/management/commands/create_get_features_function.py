@@ -25,9 +25,43 @@ RETURNS bytea AS $$
 DECLARE
     mvt bytea;
     map_layer integer;
+    layer_storage varchar;
+    layer_grid_version varchar;
+    layer_score_fields jsonb;
 BEGIN
     map_layer := (query_params->>'map_layer')::integer;
 
+    SELECT storage, grid_version, score_fields::jsonb INTO layer_storage, layer_grid_version, layer_score_fields
+    FROM maps_app_maplayer WHERE id = map_layer;
+
+    IF layer_storage = 'grid_scores' THEN
+        -- Слой расчета хранит только баллы ячеек, геометрия берётся из общей сетки
+        SELECT INTO mvt ST_AsMVT(tile, 'get_features', 4096, 'geometry') FROM (
+            SELECT
+                ST_AsMVTGeom(
+                    ST_Transform(cell.geometry, 3857),
+                    ST_TileEnvelope(z, x, y),
+                    4096, 64, true
+                ) AS geometry,
+                jsonb_build_object(
+                    'map_layer_id', cell_score.map_layer_id,
+                    'id', cell.cell_id,
+                    'type', 'Feature',
+                    'score', cell_score.score::text
+                ) || COALESCE((
+                    SELECT jsonb_object_agg(field.name, cell_score.poi_scores[field.ordinal]::text)
+                    FROM jsonb_array_elements_text(layer_score_fields) WITH ORDINALITY AS field(name, ordinal)
+                ), '{}'::jsonb) AS properties
+            FROM maps_app_gridcell AS cell
+            JOIN maps_app_scoringcellscore AS cell_score ON cell_score.cell_id = cell.cell_id
+            WHERE cell_score.map_layer_id = map_layer AND
+                  cell.grid_version = layer_grid_version AND
+                  cell.geometry && ST_Transform(ST_TileEnvelope(z, x, y), 4326)
+        ) AS tile WHERE geometry IS NOT NULL;
+
+        RETURN mvt;
+    END IF;
+
     SELECT INTO mvt ST_AsMVT(tile, 'get_features', 4096, 'geometry') FROM (
         SELECT
             ST_AsMVTGeom(
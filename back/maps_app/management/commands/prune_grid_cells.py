@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from maps_app.grid_cache import get_grid_version
+from maps_app.grid_scores import H3_GRID_VERSION, delete_outdated_grid_cells
+
+
+class Command(BaseCommand):
+    help = 'Deletes shared grid cells of outdated grid versions that no scoring layer references'
+
+    def handle(self, *args, **options):
+        current_versions = [H3_GRID_VERSION, get_grid_version(settings.SCORING_GRID_PATH)]
+        deleted = delete_outdated_grid_cells([version for version in current_versions if version])
+        self.stdout.write(self.style.SUCCESS(f'Grid cells deleted: {deleted}'))
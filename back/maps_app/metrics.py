@@ -0,0 +1,169 @@
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+PROGRESS_FIELDS = ['calculate_scoring_progress', 'polygon_import_progress', 'metrics', 'updated_at']
+
+
+class TransientTask:
+    """
+    Stands in for a scoring task where nothing may be saved: partitions of a distributed run, previews
+    and benchmarks.
+    Collects stage metrics, has no checkpoints.
+    """
+    calculate_scoring_progress = 0
+    polygon_import_progress = 0
+
+    pk = None
+
+    def __init__(self):
+        self.metrics = {'stages': []}
+        self.checkpoint = {}
+
+    def save(self, *args, **kwargs):
+        pass
+
+
+# Открытые замеры памяти всех потоков процесса. Пик процесса (VmHWM) один на всех, поэтому перед каждым
+# сбросом он учитывается во всех открытых замерах
+_open_peaks = []
+_peaks_lock = threading.Lock()
+_hwm_resettable = None
+
+
+def get_peak_rss_mb():
+    # ru_maxrss в Linux в килобайтах, это пик процесса с момента запуска
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_rss_mb():
+    # Текущий RSS процесса, второе поле statm - резидентные страницы
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss_mb()
+
+
+def read_hwm_mb():
+    # VmHWM - пик RSS процесса с запуска или с последнего сброса через clear_refs
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_hwm():
+    global _hwm_resettable
+    if _hwm_resettable is False:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        _hwm_resettable = True
+    except OSError:
+        _hwm_resettable = False
+    return _hwm_resettable
+
+
+def _fold_peak():
+    # Вызывается под _peaks_lock: пик с прошлого сброса учитывается во всех открытых замерах и сбрасывается.
+    # Если пик сбросить нельзя, он копится с запуска процесса, и тогда замеры видят только текущий RSS
+    hwm = read_hwm_mb() if _hwm_resettable is not False else None
+    level = get_rss_mb()
+    if hwm is not None and reset_hwm():
+        level = max(level, hwm)
+    for peak in _open_peaks:
+        peak.peak_mb = max(peak.peak_mb, level)
+
+
+class MemoryPeak:
+    """
+    Peak and change of the resident memory of the process while a block runs.
+    Works in long-lived worker processes: the kernel peak counter is reset at stage boundaries,
+    so a stage does not inherit the peak of earlier tasks.
+    """
+
+    def __init__(self):
+        self.start_mb = self.end_mb = self.peak_mb = 0
+
+    def __enter__(self):
+        with _peaks_lock:
+            _fold_peak()
+            self.start_mb = self.peak_mb = get_rss_mb()
+            _open_peaks.append(self)
+        return self
+
+    def __exit__(self, *args):
+        with _peaks_lock:
+            _fold_peak()
+            _open_peaks.remove(self)
+            self.end_mb = get_rss_mb()
+            self.peak_mb = max(self.peak_mb, self.end_mb)
+        return False
+
+    @property
+    def delta_mb(self):
+        return self.end_mb - self.start_mb
+
+    def to_stage(self):
+        return {'peak_rss_mb': round(self.peak_mb, 1), 'rss_delta_mb': round(self.delta_mb, 1)}
+
+
+def save_task_progress(task, force=False):
+    """
+    Saves progress and metrics of a scoring task at most once per SCORING_PROGRESS_SAVE_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    last_save = getattr(task, '_last_progress_save', None)
+    if not force and last_save is not None and now - last_save < settings.SCORING_PROGRESS_SAVE_INTERVAL:
+        return
+    task._last_progress_save = now
+    # Сохраняем только поля прогресса, чтобы не затереть статус, выставленный, например, при убийстве задачи
+    task.save(update_fields=PROGRESS_FIELDS)
+
+
+def add_stage(task, stage):
+    task.metrics.setdefault('stages', []).append(stage)
+
+
+@contextmanager
+def track_stage(task, name, **details):
+    """
+    Records wall time, peak and change of resident memory and row count of a scoring stage into task.metrics.
+    The stage dict is yielded so the caller can fill in `rows` and other details.
+    """
+    stage = {'name': name, **details}
+    start = time.perf_counter()
+    memory = MemoryPeak()
+    try:
+        with memory:
+            yield stage
+    finally:
+        stage['seconds'] = round(time.perf_counter() - start, 3)
+        stage.update(memory.to_stage())
+        add_stage(task, stage)
+        save_task_progress(task)
+
+
+def get_stages_peak_rss_mb(metrics):
+    # Пик памяти расчета - наибольший из пиков его этапов, в том числе посчитанных в других процессах
+    return max((stage.get('peak_rss_mb', 0) for stage in (metrics or {}).get('stages', [])), default=0)
+
+
+def summarize_stages(metrics):
+    # Суммарное время и строки по каждому виду этапа, пик памяти - максимальный
+    summary = {}
+    for stage in (metrics or {}).get('stages', []):
+        total = summary.setdefault(stage['name'], {'seconds': 0, 'rows': 0, 'peak_rss_mb': 0})
+        total['seconds'] = round(total['seconds'] + stage.get('seconds', 0), 3)
+        total['rows'] += stage.get('rows', 0)
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], stage.get('peak_rss_mb', 0))
+    return summary
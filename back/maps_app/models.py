@@ -4,6 +4,7 @@ from decimal import Decimal
 from django.contrib.gis.db import models as gis_models
 from users_app.models import Company, User
 from django.db import models
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.postgres.fields import ArrayField
 
@@ -49,6 +50,10 @@ class Map(models.Model):
 
 
 class MapLayer(models.Model):
+    STORAGE_CHOICES = [
+        ('features', 'Объекты'),
+        ('grid_scores', 'Баллы ячеек сетки'),
+    ]
     LINE_STYLE_CHOICES = [
         ('solid', 'Сплошная'),
         ('dash', 'Пунктирная'),
@@ -61,6 +66,8 @@ class MapLayer(models.Model):
     maps = models.ManyToManyField(Map, related_name='layers', verbose_name="Карты")
 
     is_active = models.BooleanField(default=False)
+    # Ошибка загрузки файла слоя: по ней части загрузки перестают писать объекты
+    error = models.TextField(null=True, blank=True, verbose_name="Ошибка загрузки")
 
     # Point style
     point_radius = models.FloatField(verbose_name="Радиус точки", default=5)
@@ -124,6 +131,11 @@ class MapLayer(models.Model):
     polygon_color_palette = models.JSONField(default=dict, null=True, blank=True,
                                              verbose_name="Цветовая палитра (JSON)")
 
+    # Слои расчета баллов хранят только баллы ячеек, геометрия берётся из общей сетки
+    storage = models.CharField(max_length=20, choices=STORAGE_CHOICES, default='features', verbose_name="Хранение")
+    grid_version = models.CharField(max_length=64, null=True, blank=True, verbose_name="Версия сетки")
+    score_fields = models.JSONField(default=list, blank=True, verbose_name="Категории баллов ячеек")
+
     class Meta:
         app_label = 'maps_app'
         verbose_name = "Слой"
@@ -176,6 +188,7 @@ class Feature(models.Model):
     type = models.CharField(max_length=50, verbose_name="Тип объекта")
     properties = models.JSONField(verbose_name="Свойства")
     geometry = gis_models.GeometryField(srid=4326, verbose_name="Геометрия", null=True, blank=True)
+    h3_index = models.BigIntegerField(null=True, blank=True, db_index=True, verbose_name="Индекс H3")
 
     def __str__(self):
         return f"Feature in {self.map_layer.name}"
@@ -186,6 +199,37 @@ class Feature(models.Model):
         ordering = ['id']
 
 
+class GridCell(models.Model):
+    grid_version = models.CharField(max_length=64, verbose_name="Версия сетки")
+    cell_id = models.BigIntegerField(verbose_name="ID ячейки")
+    geometry = gis_models.GeometryField(srid=4326, verbose_name="Геометрия")
+
+    def __str__(self):
+        return f"Cell {self.cell_id} of grid {self.grid_version}"
+
+    class Meta:
+        verbose_name = "Ячейка сетки"
+        verbose_name_plural = "Ячейки сетки"
+        unique_together = ('grid_version', 'cell_id')
+
+
+class ScoringCellScore(models.Model):
+    map_layer = models.ForeignKey(MapLayer, related_name='cell_scores', on_delete=models.CASCADE, db_index=False,
+                                  verbose_name="Слой")
+    cell_id = models.BigIntegerField(verbose_name="ID ячейки")
+    score = models.FloatField(verbose_name="Балл")
+    # Порядок категорий задаёт score_fields слоя
+    poi_scores = ArrayField(models.FloatField(), default=list, blank=True, verbose_name="Баллы по категориям")
+
+    def __str__(self):
+        return f"Cell {self.cell_id} in {self.map_layer.name}"
+
+    class Meta:
+        verbose_name = "Балл ячейки"
+        verbose_name_plural = "Баллы ячеек"
+        indexes = [models.Index(fields=['map_layer', 'cell_id'])]
+
+
 class POIConfig(models.Model):
     name = models.CharField(max_length=100, verbose_name="Название POI")
     max_score = models.IntegerField(verbose_name="Максимальный балл")
@@ -207,20 +251,64 @@ class CreateScoringMapLayerTask(models.Model):
         ('failed', 'Ошибка'),
         ('killed', 'Убит')
     ]
+    BACKEND_CHOICES = [
+        ('reference', 'Эталонный'),
+        ('vectorized', 'Векторизованный'),
+        ('parallel', 'Параллельный по категориям'),
+        ('sql', 'PostGIS'),
+        ('h3', 'Сетка H3'),
+        ('distributed', 'Распределенный по воркерам'),
+        ('low_memory', 'Экономный по памяти'),
+        ('fft', 'Быстрый приближенный (БПФ)'),
+    ]
+    NORMALIZATION_CHOICES = [
+        ('city', 'По городам'),
+        ('global', 'По всей сетке'),
+        ('city_quantile', 'Процентили по городам'),
+    ]
+    H3_RESOLUTION_CHOICES = [
+        (5, '5 (ребро ~8.5 км)'),
+        (6, '6 (ребро ~3.2 км)'),
+        (7, '7 (ребро ~1.2 км)'),
+        (8, '8 (ребро ~460 м)'),
+        (9, '9 (ребро ~175 м)'),
+        (10, '10 (ребро ~65 м)'),
+    ]
 
     task_id = models.CharField(max_length=255, verbose_name="ID задачи")
     layer = models.ForeignKey(MapLayer, on_delete=models.SET_NULL, verbose_name="Слой карты", null=True, blank=True)
+    company = models.ForeignKey(Company, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='scoring_tasks', verbose_name="Компания")
     status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
     error_message = models.TextField(blank=True, null=True, verbose_name="Сообщение об ошибке")
     calculate_scoring_progress = models.FloatField(default=0, verbose_name="Прогресс расчета баллов")
     polygon_import_progress = models.FloatField(default=0, verbose_name="Прогресс импорта полигонов")
+    backend = models.CharField(max_length=50, choices=BACKEND_CHOICES, default='vectorized',
+                               verbose_name="Движок расчета")
+    normalization = models.CharField(max_length=50, choices=NORMALIZATION_CHOICES, default='city',
+                                     verbose_name="Нормализация баллов")
+    h3_resolution = models.PositiveSmallIntegerField(choices=H3_RESOLUTION_CHOICES, default=8,
+                                                     verbose_name="Разрешение сетки H3")
+    cache_key = models.CharField(max_length=64, blank=True, null=True, db_index=True,
+                                 verbose_name="Ключ результата расчета")
+    source_task = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='followers',
+                                    verbose_name="Задача с результатом")
+    params = models.JSONField(default=dict, blank=True, verbose_name="Параметры расчета")
+    checkpoint = models.JSONField(default=dict, blank=True, verbose_name="Контрольная точка")
+    metrics = models.JSONField(default=dict, blank=True, verbose_name="Метрики этапов")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата и время создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата и время последнего редактирования")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Время запуска")
     end_time = models.DateTimeField(null=True, blank=True, verbose_name="Время окончания")
 
     def __str__(self):
         return f'Task {self.task_id} - {self.get_status_display()}'
 
+    def fail_followers(self, message):
+        # Задачи, ожидавшие результат этой задачи, завершаются вместе с ней
+        self.followers.filter(status='pending').update(status='failed', error_message=message,
+                                                       end_time=timezone.now())
+
     class Meta:
         verbose_name = "Задача создания слоя карты"
         verbose_name_plural = "Задачи создания слоев карт"
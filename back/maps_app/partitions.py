@@ -0,0 +1,131 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from maps_app.checkpoints import get_checkpoint_dir
+from maps_app.grid_cache import get_centroid_coords
+from maps_app.models import CreateScoringMapLayerTask
+
+
+def split_positions(positions, coords, max_cells):
+    # Делим пополам по медиане вдоль длинной стороны охвата, пока часть не станет меньше лимита
+    if len(positions) <= max_cells:
+        return [positions]
+    part_coords = coords[positions]
+    axis = int(np.ptp(part_coords[:, 0]) < np.ptp(part_coords[:, 1]))
+    middle = len(positions) // 2
+    order = np.argpartition(part_coords[:, axis], middle)
+    return (split_positions(positions[order[:middle]], coords, max_cells) +
+            split_positions(positions[order[middle:]], coords, max_cells))
+
+
+def split_grid_positions(grid, max_cells, pack_cities=True):
+    """
+    Splits the grid into spatially compact parts of at most max_cells cells and returns their positions.
+    Large cities are cut into tiles, small neighbouring cities are packed together unless pack_cities is off.
+    """
+    coords = get_centroid_coords(grid)
+    codes, _ = pd.factorize(grid['city_name'])
+    order = np.argsort(codes, kind='stable')
+    _, starts = np.unique(codes[order], return_index=True)
+    cities = np.split(order, starts[1:]) if len(order) else []
+    # Соседние города упаковываются вместе, поэтому идём по ним с запада на восток
+    cities.sort(key=lambda positions: coords[positions, 0].mean())
+
+    parts, pack = [], []
+    for positions in cities:
+        if len(positions) > max_cells or not pack_cities:
+            parts.extend(split_positions(positions, coords, max_cells))
+            continue
+        if sum(map(len, pack)) + len(positions) > max_cells:
+            parts.append(np.concatenate(pack))
+            pack = []
+        pack.append(positions)
+    if pack:
+        parts.append(np.concatenate(pack))
+
+    return [np.sort(positions) for positions in parts]
+
+
+def split_grid_partitions(grid, max_cells):
+    # Части распределенного расчета храним по меткам сетки: воркеры берут ячейки из полной сетки
+    labels = grid.index.to_numpy()
+    return [labels[positions] for positions in split_grid_positions(grid, max_cells)]
+
+
+def get_partitions_dir(task):
+    return os.path.join(get_checkpoint_dir(task), 'partitions')
+
+
+def get_partition_plan(task, total_cells):
+    # План разбиения из прошлого запуска годится, только если сетка та же
+    plan = task.checkpoint.get('partitions')
+    return plan if plan and plan.get('total') == total_cells else None
+
+
+def save_partition_plan(task, partitions, total_cells):
+    partitions_dir = get_partitions_dir(task)
+    os.makedirs(partitions_dir, exist_ok=True)
+    for index, labels in enumerate(partitions):
+        np.save(os.path.join(partitions_dir, f'cells_{index}.npy'), labels)
+    task.checkpoint['partitions'] = {'total': total_cells, 'cells': [len(labels) for labels in partitions]}
+    task.save(update_fields=['checkpoint'])
+    return task.checkpoint['partitions']
+
+
+def save_partition_task_ids(task, task_ids):
+    # Идентификаторы частей текущего запуска: остановка расчета отзывает их вместе с основной задачей
+    task.checkpoint['partition_task_ids'] = task_ids
+    task.save(update_fields=['checkpoint'])
+
+
+def get_partition_task_ids(task):
+    return task.checkpoint.get('partition_task_ids', [])
+
+
+def load_partition_cells(task, index):
+    return np.load(os.path.join(get_partitions_dir(task), f'cells_{index}.npy'))
+
+
+def get_partition_scores_path(task, index):
+    return os.path.join(get_partitions_dir(task), f'scores_{index}.npz')
+
+
+def has_partition_scores(task, index):
+    return os.path.exists(get_partition_scores_path(task, index))
+
+
+def save_partition_scores(task, index, primary_scores):
+    partitions_dir = get_partitions_dir(task)
+    fd, tmp_path = tempfile.mkstemp(prefix='.scores-', suffix='.npz', dir=partitions_dir)
+    with os.fdopen(fd, 'wb') as file:
+        np.savez(file, **{poi: np.asarray(scores_pp, dtype=np.float64) for poi, scores_pp in primary_scores.items()})
+    os.replace(tmp_path, get_partition_scores_path(task, index))
+
+
+def update_partitions_progress(task, plan):
+    # Части считаются параллельно, прогресс только растёт и пишется одним запросом без гонок
+    done = sum(cells for index, cells in enumerate(plan['cells']) if has_partition_scores(task, index))
+    progress = done / plan['total'] * 100 if plan['total'] else 100
+    CreateScoringMapLayerTask.objects.filter(pk=task.pk).update(
+        calculate_scoring_progress=Greatest(F('calculate_scoring_progress'), progress), updated_at=timezone.now()
+    )
+
+
+def iter_merged_primary_scores(task, plan, grid, poi_list):
+    """
+    Assembles primary scores of the whole grid from the partition results and yields them per category.
+    """
+    primary_scores = {poi: np.zeros(len(grid)) for poi in poi_list}
+    for index in range(len(plan['cells'])):
+        positions = grid.index.get_indexer(load_partition_cells(task, index))
+        with np.load(get_partition_scores_path(task, index)) as scores:
+            for poi in poi_list:
+                primary_scores[poi][positions] = scores[poi]
+    for poi in poi_list:
+        yield poi, primary_scores.pop(poi)
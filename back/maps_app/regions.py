@@ -0,0 +1,92 @@
+import hashlib
+import json
+
+import numpy as np
+import shapely
+from django.contrib.gis.db.models import Extent
+from pyproj import Transformer
+
+from maps_app.grid_cache import GRID_CRS, get_centroid_coords
+from maps_app.models import Feature
+
+
+def normalize_region(region):
+    """
+    Brings a region filter to {'cities': [...], 'bbox': [minx, miny, maxx, maxy]} (bbox in EPSG:4326),
+    returns None for an empty filter. Keys without a value are dropped, so equal filters are stored equally.
+    """
+    if not region:
+        return None
+    normalized = {}
+    if region.get('cities'):
+        normalized['cities'] = sorted({str(city) for city in region['cities']})
+    if region.get('bbox'):
+        normalized['bbox'] = [float(value) for value in region['bbox']]
+    return normalized or None
+
+
+def get_region_key(region):
+    region = normalize_region(region)
+    if region is None:
+        return None
+    return hashlib.sha256(json.dumps(region, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_map_layers_bbox(map_ids):
+    """
+    EPSG:4326 extent of the features of the maps' own layers, scoring layers are not counted.
+    """
+    extent = Feature.objects.filter(
+        map_layer__maps__in=map_ids, map_layer__createscoringmaplayertask__isnull=True
+    ).aggregate(extent=Extent('geometry'))['extent']
+    return list(extent) if extent else None
+
+
+def get_grid_bbox(bbox):
+    # Охват EPSG:4326 в координатах сетки
+    return Transformer.from_crs('EPSG:4326', GRID_CRS, always_xy=True).transform_bounds(*bbox)
+
+
+def clip_grid_to_region(grid, region):
+    """
+    Keeps only the cells of the region: cells of the listed cities whose centers fall into the bbox.
+    The region key is stored in grid.attrs, caches of clipped grids are kept apart from the full grid.
+    """
+    region = normalize_region(region)
+    if region is None:
+        return grid
+
+    mask = np.ones(len(grid), dtype=bool)
+    if 'cities' in region:
+        mask &= grid['city_name'].isin(region['cities']).to_numpy()
+    if 'bbox' in region:
+        xmin, ymin, xmax, ymax = get_grid_bbox(region['bbox'])
+        coords = get_centroid_coords(grid)
+        mask &= (coords[:, 0] >= xmin) & (coords[:, 0] <= xmax) & (coords[:, 1] >= ymin) & (coords[:, 1] <= ymax)
+
+    # Копия отвязывает срез от общей сетки процесса, колонки задачи пишутся в неё
+    grid = grid[mask].copy(deep=False)
+    grid.attrs['region'] = get_region_key(region)
+    return grid
+
+
+def get_coords_bounds(coords):
+    if not len(coords):
+        return None
+    return (*coords.min(axis=0), *coords.max(axis=0))
+
+
+def get_poi_in_reach(snapshot, bounds, radius):
+    """
+    Points of a snapshot within radius of the grid extent and their STRtree.
+    When every point is in reach the snapshot is returned as is with its shared index.
+    """
+    if bounds is None:
+        return snapshot.geometries[:0], None
+    xmin, ymin, xmax, ymax = bounds
+    # Запрос к индексу снимка по охвату: точки дальше радиуса от всех центроид баллов не дают
+    index = snapshot.tree.query(shapely.box(xmin - radius, ymin - radius, xmax + radius, ymax + radius))
+    if len(index) == len(snapshot.geometries):
+        return snapshot.geometries, snapshot.tree
+    geometries = snapshot.geometries[np.sort(index)]
+    return geometries, shapely.STRtree(geometries)
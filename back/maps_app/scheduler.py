@@ -0,0 +1,144 @@
+from collections import Counter, deque
+from datetime import timedelta
+from math import ceil
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from maps_app.models import CreateScoringMapLayerTask
+
+# Ключ рекомендательной блокировки: слоты раздаёт только один диспетчер за раз
+SCHEDULER_LOCK_ID = 0x5c0e1
+# Класс блокировок запусков задач: блокировку держит сессия воркера, который считает задачу
+TASK_LOCK_CLASS = 0x5c0e2
+
+
+def get_running_tasks():
+    # Задачи, копирующие готовый результат, слот не занимают
+    return CreateScoringMapLayerTask.objects.filter(status='in_progress', source_task__isnull=True)
+
+
+def get_pending_tasks():
+    return CreateScoringMapLayerTask.objects.filter(status='pending', source_task__isnull=True,
+                                                    layer__isnull=False).order_by('created_at', 'id')
+
+
+def fair_order(pending, running_per_company):
+    """
+    Orders the queue round-robin between companies: one task of each company in turn, FIFO inside a company.
+    Companies with fewer running tasks and then older requests go first.
+    """
+    queues = {}
+    for task in pending:
+        queues.setdefault(task.company_id, deque()).append(task)
+
+    companies = sorted(queues, key=lambda company: (running_per_company[company], queues[company][0].created_at))
+    ordered = []
+    while companies:
+        for company in list(companies):
+            ordered.append(queues[company].popleft())
+            if not queues[company]:
+                companies.remove(company)
+    return ordered
+
+
+def grant_scoring_slots():
+    """
+    Moves pending tasks into progress while global and per-company limits allow.
+    Must be called inside a transaction, returns the tasks to be started after commit.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [SCHEDULER_LOCK_ID])
+
+    running_per_company = Counter(get_running_tasks().values_list('company_id', flat=True))
+    free_slots = settings.SCORING_MAX_CONCURRENT_TASKS - sum(running_per_company.values())
+
+    started = []
+    for task in fair_order(get_pending_tasks(), running_per_company):
+        if free_slots <= 0:
+            break
+        if running_per_company[task.company_id] >= settings.SCORING_MAX_TASKS_PER_COMPANY:
+            continue
+
+        task.status = 'in_progress'
+        task.started_at = timezone.now()
+        task.save(update_fields=['status', 'started_at', 'updated_at'])
+        running_per_company[task.company_id] += 1
+        free_slots -= 1
+        started.append(task)
+
+    return started
+
+
+def try_lock_task(task):
+    """
+    Takes the run lock of a task for the current database session.
+    The lock is released with the session, so a task of a dead worker becomes free again.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [TASK_LOCK_CLASS, task.pk])
+        return cursor.fetchone()[0]
+
+
+def unlock_task(task):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [TASK_LOCK_CLASS, task.pk])
+
+
+def try_lock_task_shared(task):
+    """
+    Shared run lock held by partitions of a distributed task: many partitions may run at once,
+    while any of them holds it the task is not taken for orphaned.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock_shared(%s, %s)', [TASK_LOCK_CLASS, task.pk])
+        return cursor.fetchone()[0]
+
+
+def unlock_task_shared(task):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_unlock_shared(%s, %s)', [TASK_LOCK_CLASS, task.pk])
+
+
+def get_orphaned_tasks(grace):
+    """
+    Tasks in progress that no worker is running, not updated for `grace` seconds.
+    """
+    orphaned = []
+    for task in get_running_tasks().filter(layer__isnull=False,
+                                           updated_at__lt=timezone.now() - timedelta(seconds=grace)):
+        if try_lock_task(task):
+            unlock_task(task)
+            orphaned.append(task)
+    return orphaned
+
+
+def get_average_duration():
+    # Средняя длительность последних завершённых расчетов, по ней оценивается время ожидания
+    durations = [
+        (end_time - started_at).total_seconds()
+        for started_at, end_time in CreateScoringMapLayerTask.objects.filter(
+            status='completed', source_task__isnull=True, started_at__isnull=False, end_time__isnull=False
+        ).order_by('-end_time').values_list('started_at', 'end_time')[:20]
+    ]
+    return sum(durations) / len(durations) if durations else None
+
+
+def get_scoring_queue():
+    """
+    Returns {task id: (queue position, estimated start time)} of pending tasks in dispatch order.
+    """
+    running_per_company = Counter(get_running_tasks().values_list('company_id', flat=True))
+    pending = fair_order(get_pending_tasks(), running_per_company)
+    average_duration = get_average_duration()
+
+    queue = {}
+    for position, task in enumerate(pending, 1):
+        eta = None
+        if average_duration is not None:
+            # Задачи стартуют волнами по числу слотов
+            waves = ceil(position / settings.SCORING_MAX_CONCURRENT_TASKS)
+            eta = timezone.now() + timedelta(seconds=waves * average_duration)
+        queue[task.id] = (position, eta)
+    return queue
@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import numpy as np
+from django.conf import settings
+
+from maps_app.grid_cache import get_grid_version
+from maps_app.h3_scoring import get_cells_resolution
+from maps_app.poi_snapshots import check_table_name, get_poi_snapshot_version
+
+
+def get_primary_scores_dir(grid, variant=None):
+    """
+    Directory of cached primary scores of a grid, None when the grid version is unknown.
+    Approximate backends pass a variant, their scores are kept apart from the exact ones.
+    """
+    grid_version = get_grid_version(settings.SCORING_GRID_PATH)
+    if grid_version is None:
+        return None
+    name = grid_version[:16]
+    if 'h3_index' in grid:
+        # Сетки H3 разных разрешений - разные сетки
+        name = f'{name}-h3-{get_cells_resolution(grid["h3_index"].to_numpy())}'
+    if grid.attrs.get('region'):
+        # Баллы сетки, обрезанной по области, хранятся отдельно от баллов всей сетки
+        name = f'{name}-region-{grid.attrs["region"]}'
+    if variant:
+        name = f'{name}-{variant}'
+    return os.path.join(settings.SCORING_CACHE_DIR, 'primary', name)
+
+
+def get_primary_scores_path(scores_dir, poi, max_distance, polygon_radius):
+    # Первичные баллы не зависят от макс. балла категории, поэтому он не входит в имя файла
+    version = get_poi_snapshot_version(poi)
+    if scores_dir is None or version is None:
+        return None
+    return os.path.join(scores_dir, check_table_name(poi), f'{version}_{max_distance}_{float(polygon_radius):g}.npy')
+
+
+def load_primary_scores(scores_dir, poi, max_distance, polygon_radius, cells):
+    path = get_primary_scores_path(scores_dir, poi, max_distance, polygon_radius)
+    if path is None:
+        return None
+    try:
+        scores_pp = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return scores_pp if len(scores_pp) == cells else None
+
+
+def save_primary_scores(scores_dir, poi, max_distance, polygon_radius, scores_pp):
+    path = get_primary_scores_path(scores_dir, poi, max_distance, polygon_radius)
+    if path is None:
+        return
+
+    poi_dir = os.path.dirname(path)
+    os.makedirs(poi_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.scores-', suffix='.npy', dir=poi_dir)
+    with os.fdopen(fd, 'wb') as file:
+        np.save(file, np.asarray(scores_pp, dtype=np.float64))
+    os.replace(tmp_path, path)
+
+    # Баллы по устаревшим снимкам категории больше не понадобятся
+    version = os.path.basename(path).split('_')[0]
+    for name in os.listdir(poi_dir):
+        if name.endswith('.npy') and not name.startswith('.') and name.split('_')[0] != version:
+            os.remove(os.path.join(poi_dir, name))
@@ -1,13 +1,17 @@
+from django.conf import settings
 from drf_writable_nested import WritableNestedModelSerializer
 from rest_framework import serializers
 
-from maps_app.models import MapLayer, POIConfig, Map
+from maps_app.grid_scores import count_layer_objects
+from maps_app.models import MapLayer, POIConfig, Map, CreateScoringMapLayerTask
+from maps_app.regions import get_map_layers_bbox, normalize_region
 
 
 class MapLayerSerializer(serializers.ModelSerializer):
     class Meta:
         model = MapLayer
         fields = '__all__'
+        read_only_fields = ('storage', 'grid_version', 'score_fields', 'error')
 
 
 class MapLayerListSerializer(serializers.ModelSerializer):
@@ -20,7 +24,7 @@ class MapLayerListSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_features_count(obj):
-        return obj.features.count()
+        return count_layer_objects(obj)
 
     @staticmethod
     def get_maps_count(obj):
@@ -60,15 +64,76 @@ class POISerializer(serializers.ModelSerializer):
         fields = ('is_active', 'name', 'max_score', 'max_distance')
 
 
+def validate_bbox(value):
+    min_lon, min_lat, max_lon, max_lat = value
+    if not (-180 <= min_lon < max_lon <= 180 and -90 <= min_lat < max_lat <= 90):
+        raise serializers.ValidationError('Охват задаётся как [min_lon, min_lat, max_lon, max_lat].')
+    return value
+
+
+class ScoringRegionSerializer(serializers.Serializer):
+    cities = serializers.ListField(child=serializers.CharField(max_length=256), required=False, label='Города')
+    bbox = serializers.ListField(child=serializers.FloatField(), min_length=4, max_length=4, required=False,
+                                 validators=[validate_bbox], label='Охват (EPSG:4326)')
+    from_map_layers = serializers.BooleanField(default=False, label='По слоям карты')
+
+
 class MapLayerScoringCreateSerializer(serializers.Serializer):
     name = serializers.CharField(max_length='256', required=True, label='Название')
-    description = serializers.CharField(required=False, allow_blank=True, label='Описание')
-    maps = serializers.PrimaryKeyRelatedField(queryset=Map.objects.all(), label='Карта')
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True, label='Описание')
+    maps = serializers.PrimaryKeyRelatedField(queryset=Map.objects.all(), many=True, label='Карты')
+    polygon_radius = serializers.IntegerField(min_value=0, required=True, label='Полигон радиус')
+    poi = POISerializer(many=True)
+    backend = serializers.ChoiceField(choices=CreateScoringMapLayerTask.BACKEND_CHOICES, required=False,
+                                      label='Движок расчета')
+    normalization = serializers.ChoiceField(choices=CreateScoringMapLayerTask.NORMALIZATION_CHOICES, required=False,
+                                            label='Нормализация баллов')
+    h3_resolution = serializers.ChoiceField(choices=CreateScoringMapLayerTask.H3_RESOLUTION_CHOICES, required=False,
+                                            label='Разрешение сетки H3')
+    region = ScoringRegionSerializer(required=False, label='Область расчета')
+    approximate = serializers.BooleanField(default=False, label='Быстрый приближенный расчет')
+
+    class Meta:
+        fields = ('name', 'description', 'maps', 'poi', 'backend', 'normalization', 'h3_resolution', 'region',
+                  'approximate')
+
+    def validate(self, attrs):
+        # Быстрый приближенный расчет - это движок fft, в задаче хранится только движок
+        approximate = attrs.pop('approximate', False)
+        backend = attrs.get('backend')
+        if approximate:
+            if backend not in (None, 'fft'):
+                raise serializers.ValidationError(
+                    {'approximate': f'Приближенный расчет несовместим с движком {backend}.'})
+            backend = 'fft'
+        attrs['backend'] = backend or settings.SCORING_BACKEND
+        if attrs['backend'] not in dict(CreateScoringMapLayerTask.BACKEND_CHOICES):
+            raise serializers.ValidationError({'backend': f'Неизвестный движок расчета: {attrs["backend"]}.'})
+        attrs.setdefault('normalization', settings.SCORING_NORMALIZATION)
+        attrs.setdefault('h3_resolution', settings.SCORING_H3_RESOLUTION)
+
+        # Область интереса: города, охват или охват объектов слоёв самой карты
+        region = dict(attrs.get('region') or {})
+        if region.pop('from_map_layers', False):
+            region['bbox'] = get_map_layers_bbox(attrs['maps'])
+            if region['bbox'] is None:
+                raise serializers.ValidationError(
+                    {'region': 'На карте нет слоёв с объектами, область расчета не определить.'})
+        attrs['region'] = normalize_region(region)
+        return attrs
+
+
+class MapLayerScoringPreviewSerializer(serializers.Serializer):
     polygon_radius = serializers.IntegerField(min_value=0, required=True, label='Полигон радиус')
     poi = POISerializer(many=True)
+    bbox = serializers.ListField(child=serializers.FloatField(), min_length=4, max_length=4,
+                                 validators=[validate_bbox], label='Окно карты (EPSG:4326)')
+    normalization = serializers.ChoiceField(choices=CreateScoringMapLayerTask.NORMALIZATION_CHOICES, required=False,
+                                            label='Нормализация баллов')
+    approximate = serializers.BooleanField(default=False, label='Быстрый приближенный расчет')
 
     class Meta:
-        fields = ('name', 'description', 'maps', 'poi')
+        fields = ('polygon_radius', 'poi', 'bbox', 'normalization', 'approximate')
 
 
 class MapLayerPropertiesSerializer(serializers.Serializer):
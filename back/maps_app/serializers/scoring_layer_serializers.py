@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
 from maps_app.models import CreateScoringMapLayerTask
+from maps_app.scheduler import get_scoring_queue
 
 
 class ScoringLayerSerializer(serializers.ModelSerializer):
@@ -12,10 +13,28 @@ class ScoringLayerSerializer(serializers.ModelSerializer):
 class ScoringLayerListSerializer(serializers.ModelSerializer):
     maps = serializers.SerializerMethodField(label='Карта')
     layer = serializers.SerializerMethodField(label='Название')
+    queue_position = serializers.SerializerMethodField(label='Место в очереди')
+    eta = serializers.SerializerMethodField(label='Ожидаемое время запуска')
 
     class Meta:
         model = CreateScoringMapLayerTask
-        fields = ('id', 'layer', 'maps', 'status', 'created_at', 'end_time')
+        fields = ('id', 'layer', 'maps', 'status', 'backend', 'normalization', 'h3_resolution',
+                  'calculate_scoring_progress', 'polygon_import_progress', 'metrics', 'source_task',
+                  'queue_position', 'eta', 'created_at', 'started_at', 'end_time')
+
+    def get_queue(self):
+        # Очередь считается один раз на весь список
+        if 'scoring_queue' not in self.context:
+            self.context['scoring_queue'] = get_scoring_queue()
+        return self.context['scoring_queue']
+
+    def get_queue_position(self, obj):
+        position, _ = self.get_queue().get(obj.id, (None, None))
+        return position
+
+    def get_eta(self, obj):
+        _, eta = self.get_queue().get(obj.id, (None, None))
+        return eta
 
     def get_maps(self, obj):
         if obj.layer:
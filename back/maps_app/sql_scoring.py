@@ -0,0 +1,149 @@
+import io
+import logging
+from uuid import uuid4
+
+import numpy as np
+from django.conf import settings
+
+from maps_app.grid_cache import get_grid, get_grid_version, get_centroid_coords
+from maps_app.metrics import save_task_progress, track_stage
+from maps_app.poi_snapshots import check_table_name
+from maps_app.regions import get_coords_bounds
+
+logger = logging.getLogger(__name__)
+
+# Первичный балл ячейки - сумма линейно убывающих баллов точек в радиусе. Точка учитывается, если пересекает
+# буфер центроиды (как в остальных движках), ST_DWithin отбирает кандидатов по GiST-индексам.
+# Балл точки повторяет np.interp(distance, [polygon_radius, radius], [1, 0], left=1, right=0), в том числе
+# при нулевом max_distance, когда отрезок вырождается в точку и на его конце балл равен 0.
+# Вторичный балл - корень 8-й степени, нормированный на максимум категории.
+# При расчете по области ячейки ограничены её списком, а точки - охватом области, расширенным на радиус.
+REGION_FILTER_SQL = """
+      AND g.cell_id = ANY(%(cell_ids)s)
+      AND p.geom && ST_MakeEnvelope(%(xmin)s - %(radius)s, %(ymin)s - %(radius)s,
+                                    %(xmax)s + %(radius)s, %(ymax)s + %(radius)s, 3857)
+"""
+CATEGORY_SCORES_SQL = """
+WITH primary_scores AS (
+    SELECT g.cell_id,
+           sum(CASE
+                   WHEN d.distance < %(polygon_radius)s THEN 1.0
+                   WHEN d.distance >= %(radius)s THEN 0.0
+                   ELSE (%(radius)s - d.distance) / NULLIF(%(max_distance)s, 0)
+               END) AS score_pp
+    FROM {grid_table} g
+    JOIN {poi_table} p ON ST_DWithin(g.centroid, p.geom, %(radius)s)
+    CROSS JOIN LATERAL (SELECT ST_Distance(g.centroid, p.geom) AS distance) d
+    WHERE (d.distance <= %(radius)s * cos(pi() / 64)
+           OR ST_Intersects(ST_Buffer(g.centroid, %(radius)s, 'quad_segs=16'), p.geom))
+      {region_filter}
+    GROUP BY g.cell_id
+)
+INSERT INTO {result_table} (cell_id, score)
+SELECT cell_id, %(max_score)s * power(score_pp / max(score_pp) OVER (), 1.0 / 8)
+FROM primary_scores
+WHERE score_pp > 0
+"""
+
+
+def get_sql_grid_table():
+    return f'scoring_grid_{get_grid_version(settings.SCORING_GRID_PATH)[:16]}'
+
+
+def ensure_sql_grid(connection):
+    """
+    Loads centroids of the cached grid into the OSM database once per grid version.
+    """
+    grid = get_grid(settings.SCORING_GRID_PATH)
+    table = get_sql_grid_table()
+
+    with connection.cursor() as cursor:
+        # Блокировка не даёт двум задачам одновременно заливать одну и ту же сетку
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [table])
+        cursor.execute('SELECT to_regclass(%s)', [table])
+        if cursor.fetchone()[0] is None:
+            cursor.execute(f"""
+                CREATE TABLE {table} (
+                    cell_id integer PRIMARY KEY,
+                    x double precision NOT NULL,
+                    y double precision NOT NULL,
+                    centroid geometry(Point, 3857) GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(x, y), 3857)) STORED
+                )
+            """)
+            coords = get_centroid_coords(grid)
+            buffer = io.StringIO()
+            for cell_id, (x, y) in zip(grid.index, coords):
+                buffer.write(f'{cell_id},{x!r},{y!r}\n')
+            buffer.seek(0)
+            cursor.copy_expert(f'COPY {table} (cell_id, x, y) FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(f'CREATE INDEX ON {table} USING gist (centroid)')
+            cursor.execute(f'ANALYZE {table}')
+            logger.info('Grid loaded into the OSM database: %s', table)
+    connection.commit()
+
+    return table
+
+
+def calculate_scoring_sql(engine, grid, poi_list, polygon_radius, task):
+    """
+    Computes scores inside the OSM database, only the total score of each cell comes back.
+    Per-category columns are not added to the grid.
+    """
+    connection = engine.raw_connection()
+    result_table = f'scoring_result_{uuid4().hex}'
+    try:
+        with track_stage(task, 'grid_upload', rows=len(grid)):
+            grid_table = ensure_sql_grid(connection)
+
+        # Сетка обрезана по области: считаем только её ячейки и точки в пределах досягаемости
+        region_params = {}
+        if grid.attrs.get('region'):
+            xmin, ymin, xmax, ymax = get_coords_bounds(get_centroid_coords(grid)) or (0, 0, 0, 0)
+            region_params = {'cell_ids': grid.index.tolist(), 'xmin': float(xmin), 'ymin': float(ymin),
+                             'xmax': float(xmax), 'ymax': float(ymax)}
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE UNLOGGED TABLE {result_table} (cell_id integer, score double precision)')
+            connection.commit()
+
+            uniform_score = 0
+            max_poi_list = len(poi_list)
+            for processed_poi_count, (poi, params) in enumerate(poi_list.items(), 1):
+                sql = CATEGORY_SCORES_SQL.format(grid_table=grid_table, poi_table=check_table_name(poi),
+                                                 result_table=result_table,
+                                                 region_filter=REGION_FILTER_SQL if region_params else '')
+                with track_stage(task, 'scoring', category=poi) as stage:
+                    cursor.execute(sql, {
+                        'polygon_radius': polygon_radius,
+                        'max_distance': params['max-distance'],
+                        'radius': params['max-distance'] + polygon_radius,
+                        'max_score': params['max-score'],
+                        **region_params,
+                    })
+                    stage['rows'] = cursor.rowcount
+                    if cursor.rowcount == 0:
+                        # Как и np.interp в остальных движках: при нулевом максимуме все ячейки получают макс. балл
+                        uniform_score += params['max-score']
+                    connection.commit()
+
+                task.calculate_scoring_progress = (processed_poi_count / max_poi_list) * 100
+                save_task_progress(task)
+
+            cursor.execute(f'SELECT cell_id, sum(score) FROM {result_table} GROUP BY cell_id')
+            rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 2)
+    finally:
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {result_table}')
+        connection.commit()
+        connection.close()
+
+    scores = np.zeros(len(grid))
+    positions = grid.index.get_indexer(rows[:, 0].astype(np.int64))
+    scores[positions[positions >= 0]] = rows[positions >= 0, 1]
+    grid['score'] = grid['score'] + scores + uniform_score
+
+    task.calculate_scoring_progress = 100
+    save_task_progress(task, force=True)
+
+    return grid
@@ -1,34 +1,53 @@
-from celery import shared_task
-import json
-import csv
-from maps_app.models import MapLayer, CreateScoringMapLayerTask
+from functools import partial
+from celery import shared_task, chord
+from celery.signals import worker_ready
+from celery.utils import uuid
+from django.conf import settings
+from django.db import transaction
+from maps_app.models import Feature, MapLayer, CreateScoringMapLayerTask
+from maps_app.bulk_loader import LayerLoadCancelled
+from maps_app.checkpoints import clear_checkpoint
+from maps_app.partitions import has_partition_scores, save_partition_task_ids, update_partitions_progress
+from maps_app.upload_chunks import plan_upload_chunks
+from maps_app.uploads import verify_layer_upload, open_layer_upload, delete_layer_upload
+from maps_app.scheduler import grant_scoring_slots, get_orphaned_tasks, try_lock_task, unlock_task, \
+    try_lock_task_shared, unlock_task_shared
 from maps_app.utils import process_geojson_features, process_csv_features, process_scoring_features, \
-    send_layer_activity_update
+    send_layer_activity_update, get_scoring_cache_key, copy_layer_features, start_scoring_metrics, \
+    plan_distributed_scoring, score_grid_partition, merge_distributed_scoring
 from django.utils import timezone
+from geosight.celery import app
 
 
 @shared_task(name="create_features")
-def create_features(map_layer_id, file_name, file_contents):
+def create_features(map_layer_id, file_name, upload_path, checksum):
     print('Starting create_features task')
     instance = MapLayer.objects.get(id=map_layer_id)
+    chunked = False
     try:
         print(f'Processing layer: {instance.name}')
 
-        if file_name.endswith('.geojson'):
-            geojson = json.loads(file_contents)
-            process_geojson_features(geojson, instance)
-
-        elif file_name.endswith('.csv'):
-            decoded_file = file_contents.decode('utf-8').splitlines()
-            reader = csv.DictReader(decoded_file)
-            process_csv_features(reader, instance)
-
-        else:
+        if not file_name.endswith(('.geojson', '.csv')):
             instance.error = 'Unsupported file type'
             instance.save()
             print(f'Unsupported file type for layer: {instance.name}')
             return
 
+        verify_layer_upload(upload_path, checksum)
+        chunks = plan_upload_chunks(upload_path, file_name)
+        if chunks and len(chunks) > 1:
+            # Большой файл загружают части на разных воркерах, слой включит завершающая задача
+            start_chunked_features(instance, file_name, upload_path, chunks)
+            chunked = True
+            return
+
+        # Файл разбирается потоком, целиком в память документ не загружается
+        with open_layer_upload(upload_path) as file:
+            if file_name.endswith('.geojson'):
+                process_geojson_features(file, instance)
+            else:
+                process_csv_features(file, instance)
+
         instance.is_active = True
         instance.save()
         print(f'Complete create features for layer: {instance.name}')
@@ -36,19 +55,272 @@ def create_features(map_layer_id, file_name, file_contents):
         send_layer_activity_update(instance)
     except Exception as e:
         print(f'Error processing layer {instance.name}: {e}')
+    finally:
+        # Файл частей удаляет завершающая задача
+        if not chunked:
+            delete_layer_upload(upload_path)
+
+
+def start_chunked_features(instance, file_name, upload_path, chunks):
+    """
+    Sends the chunks of an upload as a chord: chunks are ingested on any workers in parallel,
+    the last one to finish activates the layer.
+    """
+    print(f'Layer {instance.name}: ingesting {upload_path} in {len(chunks)} chunks')
+    # Идентификаторы частей известны заранее, чтобы при ошибке отозвать ещё не начатые
+    chunk_ids = [uuid() for _ in chunks]
+    header = [create_features_chunk.s(instance.id, file_name, upload_path, ranges).set(task_id=chunk_id)
+              for ranges, chunk_id in zip(chunks, chunk_ids)]
+    finish = finish_chunked_features.s(instance.id, upload_path)
+    chord(header)(finish.on_error(fail_chunked_features.s(instance.id, upload_path, chunk_ids)))
+
+
+@shared_task(name="create_features_chunk")
+def create_features_chunk(map_layer_id, file_name, upload_path, ranges):
+    instance = MapLayer.objects.get(id=map_layer_id)
+    if instance.error:
+        print(f'Layer {instance.name}: load has failed, chunk skipped')
+        return
+    try:
+        with open_layer_upload(upload_path, ranges) as file:
+            if file_name.endswith('.geojson'):
+                process_geojson_features(file, instance, chunk=True)
+            else:
+                process_csv_features(file, instance, chunk=True)
+    except LayerLoadCancelled:
+        # Другая часть упала, пока эта загружалась: её объекты откатились вместе с транзакцией
+        print(f'Layer {instance.name}: load has failed, chunk cancelled')
+
+
+@shared_task(name="finish_chunked_features")
+def finish_chunked_features(results, map_layer_id, upload_path):
+    instance = MapLayer.objects.get(id=map_layer_id)
+    try:
+        instance.is_active = True
+        instance.save()
+        print(f'Complete create features for layer: {instance.name}')
+
+        send_layer_activity_update(instance)
+    finally:
+        delete_layer_upload(upload_path)
+
 
+@shared_task(name="fail_chunked_features")
+def fail_chunked_features(request, exc, traceback, map_layer_id, upload_path, chunk_ids=()):
+    """
+    Error handler of the chunks chord, may be called once per failed chunk. The layer stays inactive
+    as after an error in a single task.
+    """
+    print(f'Error processing layer {map_layer_id}: {exc}')
+    # Части в очереди не запускаем, идущие остановит ошибка слоя
+    app.control.revoke(list(chunk_ids))
+    with transaction.atomic():
+        # Обновление ждёт транзакции частей, которые держат строку слоя, и только после них объекты удаляются
+        MapLayer.objects.filter(id=map_layer_id, error__isnull=True).update(error=f'Ошибка загрузки файла: {exc}')
+        Feature.objects.filter(map_layer_id=map_layer_id).delete()
+    delete_layer_upload(upload_path)
 
-@shared_task(name="create_scoring_features")
-def create_scoring_features(map_layer_id, poi_data, polygon_radius):
+
+# Сообщение подтверждается только после выполнения: если воркер умер, брокер отдаст задачу снова
+@shared_task(bind=True, name="create_scoring_features", acks_late=True, reject_on_worker_lost=True)
+def create_scoring_features(self, map_layer_id, poi_data, polygon_radius, backend=None, normalization=None,
+                            h3_resolution=None, region=None):
     print('map_layer_id create_scoring_features:', map_layer_id)
     print('poi_data create_scoring_features:', poi_data)
     print('polygon_radius create_scoring_features:', polygon_radius)
-    instance = MapLayer.objects.get(id=map_layer_id)
+    task = CreateScoringMapLayerTask.objects.select_related('layer').filter(layer_id=map_layer_id).first()
+    if task is None or task.status != 'in_progress':
+        print(f'Scoring task of layer {map_layer_id} is not in progress, skipping')
+        return
+    # Задачу переотправили при восстановлении, сообщение прошлого запуска из брокера уже не актуально
+    if task.task_id != self.request.id:
+        print(f'Scoring task {task.id} was resent as {task.task_id}, skipping stale run {self.request.id}')
+        return
+    # Повторно доставленное сообщение не должно запустить второй расчет той же задачи
+    if not try_lock_task(task):
+        print(f'Scoring task {task.id} is already running, skipping')
+        return
+
+    instance = task.layer
     print('create_scoring_features', instance)
-    task = CreateScoringMapLayerTask.objects.get(layer=instance)
     try:
         print(f'Processing layer: {instance.name}')
-        process_scoring_features(map_layer_id, task, poi_data, polygon_radius)
+        backend = backend or task.backend
+        normalization = normalization or task.normalization
+        h3_resolution = h3_resolution or task.h3_resolution
+        if backend == 'distributed':
+            # Дальше задачу ведут расчеты частей сетки на разных воркерах и финальная сборка результата
+            start_distributed_scoring(task, poi_data, polygon_radius, normalization, region)
+            return
+        process_scoring_features(map_layer_id, task, poi_data, polygon_radius, backend, normalization, h3_resolution,
+                                 region)
+        complete_scoring_task(task, poi_data, polygon_radius, normalization, backend, h3_resolution, region)
+    except Exception as e:
+        fail_scoring_task(task, str(e))
+    finally:
+        unlock_task(task)
+        # Слот освободился - запускаем следующие задачи из очереди
+        dispatch_scoring_tasks()
+
+
+def complete_scoring_task(task, poi_data, polygon_radius, normalization, backend, h3_resolution, region):
+    instance = task.layer
+    instance.is_active = True
+    instance.save()
+    # Снимки POI могли собраться только во время расчета, ключ результата считаем заново
+    task.cache_key = get_scoring_cache_key(poi_data, polygon_radius, normalization, backend, h3_resolution, region)
+    task.status = 'completed'
+    task.end_time = timezone.now()
+    clear_checkpoint(task)
+    task.save()
+    print(f'Complete create features for layer: {instance.name}')
+
+    send_layer_activity_update(instance)
+    for follower in task.followers.filter(status='pending'):
+        start_cached_scoring(follower)
+
+
+def fail_scoring_task(task, message):
+    task.status = 'failed'
+    task.error_message = message
+    task.end_time = timezone.now()
+    task.save()
+    task.fail_followers(message)
+    print(f'Error processing layer {task.layer}: {message}')
+
+
+def start_distributed_scoring(task, poi_data, polygon_radius, normalization, region):
+    """
+    Splits the grid into partitions and sends the ones not scored yet as a chord:
+    partitions are scored on any workers, the last one to finish triggers the merge.
+    """
+    start_scoring_metrics(task, 'distributed', normalization, region)
+    plan = plan_distributed_scoring(task, region)
+    run_id = task.task_id
+    missing = [index for index in range(len(plan['cells'])) if not has_partition_scores(task, index)]
+    print(f'Distributed scoring of task {task.id}: {len(missing)} of {len(plan["cells"])} partitions to score')
+
+    finish = finish_distributed_scoring.s(task.id, run_id, poi_data, polygon_radius, normalization, region)
+    if not missing:
+        finish.delay([])
+        return
+    partition_ids = [uuid() for _ in missing]
+    save_partition_task_ids(task, partition_ids)
+    header = [score_scoring_partition.s(task.id, run_id, index, poi_data, polygon_radius).set(task_id=partition_id)
+              for index, partition_id in zip(missing, partition_ids)]
+    chord(header)(finish.on_error(fail_distributed_scoring.s(task.id, run_id)))
+
+
+def get_distributed_task(task_id, run_id):
+    # Сообщения убитого или перезапущенного расчета пропускаем
+    task = CreateScoringMapLayerTask.objects.select_related('layer').filter(id=task_id).first()
+    if task is None or task.status != 'in_progress' or task.task_id != run_id:
+        print(f'Distributed scoring run {run_id} of task {task_id} is not current, skipping')
+        return None
+    return task
+
+
+@shared_task(name="score_scoring_partition", acks_late=True, reject_on_worker_lost=True)
+def score_scoring_partition(task_id, run_id, index, poi_data, polygon_radius):
+    task = get_distributed_task(task_id, run_id)
+    if task is None or has_partition_scores(task, index):
+        return []
+    print(f'Scoring partition {index} of task {task_id}')
+    # Пока считается хотя бы одна часть, задача не считается брошенной
+    locked = try_lock_task_shared(task)
+    try:
+        stages = score_grid_partition(task, index, poi_data, polygon_radius)
+        update_partitions_progress(task, task.checkpoint['partitions'])
+        return stages
+    finally:
+        if locked:
+            unlock_task_shared(task)
+
+
+@shared_task(name="finish_distributed_scoring", acks_late=True, reject_on_worker_lost=True)
+def finish_distributed_scoring(partition_stages, task_id, run_id, poi_data, polygon_radius, normalization, region):
+    task = get_distributed_task(task_id, run_id)
+    if task is None or not try_lock_task(task):
+        return
+    try:
+        merge_distributed_scoring(task.layer_id, task, poi_data, polygon_radius, normalization, region,
+                                  [stage for stages in partition_stages for stage in stages])
+        complete_scoring_task(task, poi_data, polygon_radius, normalization, 'distributed', None, region)
+    except Exception as e:
+        fail_scoring_task(task, str(e))
+    finally:
+        unlock_task(task)
+        dispatch_scoring_tasks()
+
+
+@shared_task(name="fail_distributed_scoring")
+def fail_distributed_scoring(request, exc, traceback, task_id, run_id):
+    # Обработчик ошибки chord: часть сетки не посчиталась, посчитанные остаются в контрольной точке
+    task = get_distributed_task(task_id, run_id)
+    if task is None:
+        return
+    fail_scoring_task(task, str(exc))
+    dispatch_scoring_tasks()
+
+
+def send_scoring_task(task):
+    # Celery-задача отправляется после коммита, новый task_id позволяет убить именно текущий запуск
+    task.task_id = uuid()
+    task.save(update_fields=['task_id'])
+    args = (task.layer_id, task.params.get('poi', []), task.params.get('polygon_radius', 0), task.backend,
+            task.normalization, task.h3_resolution, task.params.get('region'))
+    transaction.on_commit(partial(create_scoring_features.apply_async, args, task_id=task.task_id))
+
+
+def dispatch_scoring_tasks():
+    """
+    Re-sends scoring tasks left in progress by a dead or redeployed worker (they resume from their checkpoints)
+    and starts pending tasks while there are free slots. Celery tasks are sent after commit.
+    """
+    with transaction.atomic():
+        for task in get_orphaned_tasks(settings.SCORING_RECOVERY_GRACE):
+            if not task.params and not task.checkpoint:
+                # Задача запущена до сохранения параметров расчета: продолжить её нечем
+                fail_scoring_task(task, 'Расчет прерван, параметры расчета не сохранены. Запустите расчет заново.')
+                continue
+            print(f'Resuming scoring task {task.id} from checkpoint')
+            send_scoring_task(task)
+        for task in grant_scoring_slots():
+            send_scoring_task(task)
+
+
+@shared_task(name="recover_scoring_tasks")
+def recover_scoring_tasks():
+    dispatch_scoring_tasks()
+
+
+@worker_ready.connect
+def resume_scoring_tasks(**kwargs):
+    # Воркер только что запущен: задачи в работе без блокировки могли остаться от прошлых запусков.
+    # Недавно обновлённые проверяем, когда истечёт срок: их сообщения ещё могут лежать в брокере
+    dispatch_scoring_tasks()
+    recover_scoring_tasks.apply_async(countdown=settings.SCORING_RECOVERY_GRACE)
+
+
+def start_cached_scoring(task):
+    # Копирование запускает только тот, кто первым переведёт задачу из ожидания
+    task_id = uuid()
+    if CreateScoringMapLayerTask.objects.filter(id=task.id, status='pending').update(status='in_progress',
+                                                                                     task_id=task_id):
+        copy_scoring_features.apply_async((task.id,), task_id=task_id)
+
+
+@shared_task(name="copy_scoring_features")
+def copy_scoring_features(task_id):
+    task = CreateScoringMapLayerTask.objects.select_related('layer', 'source_task').get(id=task_id)
+    instance = task.layer
+    try:
+        source_task = task.source_task
+        if source_task is None or source_task.layer_id is None:
+            raise ValueError('Слой с результатом расчета был удалён')
+
+        print(f'Copying scoring features of layer {source_task.layer_id} into layer: {instance.name}')
+        copy_layer_features(source_task.layer_id, instance.id, task)
         instance.is_active = True
         instance.save()
         task.status = 'completed'
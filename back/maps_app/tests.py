@@ -1,3 +1,770 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from math import cos, pi
+from unittest import mock
 
-# Create your tests here.
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from django.contrib.gis.geos import Point
+from h3.api import basic_int as h3
+from pyproj import Transformer
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from maps_app.bulk_loader import FeatureLoader, copy_feature_rows, rings_to_hex_ewkb
+from maps_app.checkpoints import clear_checkpoint, get_import_offset, load_category_checkpoint, \
+    save_category_checkpoint, save_import_checkpoint
+from maps_app.csv_features import get_csv_properties
+from maps_app.geojson_stream import find_features_start, iter_geojson_features, iter_json_values
+from maps_app.grid_scores import copy_cell_scores, copy_grid_cells, delete_outdated_grid_cells, \
+    get_cell_properties, get_layer_property_lookup
+from maps_app.h3_scoring import get_poi_buckets, get_ring_size, iter_h3_neighbors
+from maps_app.models import CreateScoringMapLayerTask, Feature, GridCell, MapLayer, ScoringCellScore
+from maps_app.metrics import TransientTask
+from maps_app.partitions import iter_merged_primary_scores, save_partition_plan, save_partition_scores, \
+    split_grid_partitions, split_grid_positions
+from maps_app.poi_snapshots import PoiSnapshot
+from maps_app.regions import clip_grid_to_region, get_poi_in_reach, get_region_key
+from maps_app.scheduler import fair_order, grant_scoring_slots
+from maps_app.upload_chunks import plan_csv_chunks, plan_geojson_chunks
+from maps_app.uploads import RangeReader
+from maps_app.utils import apply_primary_scores, calculate_scoring, find_poi_neighbors, get_scoring_cache_key, \
+    calculate_scoring_low_memory, calculate_scoring_vectorized, iter_primary_scores_cached, iter_primary_scores_fft, \
+    iter_primary_scores_resumable, iter_primary_scores_vectorized, normalize_by_group
+from users_app.models import Company, User
+
+# Строки со скобками, запятыми, кавычками и обратными косыми чертами, которые разбор не должен принять за структуру
+TRICKY_STRINGS = ['a\\', '"', '\\"', '],{', '}', '[', ',', 'имя', '\\\\\\"']
+
+
+def make_collection(count):
+    features = [
+        {'type': 'Feature',
+         'properties': {'name': ''.join(TRICKY_STRINGS[:i % 10]), 'i': i, 'nested': [[1], {'k': [2]}]},
+         'geometry': {'type': 'Point', 'coordinates': [i + 0.125, 1.5]}}
+        for i in range(count)
+    ]
+    return {'type': 'FeatureCollection', 'name': 'layer ],"{', 'features': features, 'crs': {'name': ']'}}
+
+
+def read_ranges(raw, ranges, encoding='utf-8-sig'):
+    return ''.join(RangeReader(io.BytesIO(raw), ranges, encoding))
+
+
+def make_grid(columns, rows, size=100):
+    # Квадратные ячейки в системе координат сетки, как в кэше сетки
+    cells = [shapely.box(x * size, y * size, (x + 1) * size, (y + 1) * size)
+             for y in range(rows) for x in range(columns)]
+    grid = gpd.GeoDataFrame({'city_name': ['a' if i % 2 else 'b' for i in range(len(cells))]},
+                            geometry=cells, crs='EPSG:3857')
+    grid['score'] = 0.
+    return grid
+
+
+def use_temp_cache_dir(test_case):
+    cache_dir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(cache_dir.cleanup)
+    settings_override = override_settings(SCORING_CACHE_DIR=cache_dir.name, SCORING_GRID_PATH='grid.gpkg')
+    settings_override.enable()
+    test_case.addCleanup(settings_override.disable)
+    return cache_dir.name
+
+
+def make_snapshot(table, coords):
+    return PoiSnapshot(table, '1', np.asarray(shapely.points(np.asarray(coords, dtype=float)), dtype=object))
+
+
+def get_h3_centers(cells):
+    lat, lon = np.array([h3.h3_to_geo(cell) for cell in cells]).T
+    return np.column_stack(Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True).transform(lon, lat))
+
+
+def ring_points(center, radius, ratios):
+    # Точки у границы буфера центроиды: на лучах к вершинам 64-угольника буфера и между ними
+    angles = [pi / 64 * step for step in range(8)]
+    return [(center[0] + radius * ratio * cos(angle), center[1] + radius * ratio * np.sin(angle))
+            for angle in angles for ratio in ratios]
+
+
+class GeojsonStreamTests(SimpleTestCase):
+    def test_features_are_read_across_small_buffers(self):
+        collection = make_collection(30)
+        text = json.dumps(collection, ensure_ascii=False, indent=1)
+        for chunk_size in (1, 7, 1024):
+            self.assertEqual(list(iter_geojson_features(io.StringIO(text), chunk_size)), collection['features'])
+
+    def test_empty_collection(self):
+        self.assertEqual(list(iter_geojson_features(io.StringIO('{"type": "FeatureCollection", "features": []}'))), [])
+        self.assertEqual(list(iter_geojson_features(io.StringIO('{}'))), [])
+
+    def test_number_on_buffer_edge(self):
+        self.assertEqual(list(iter_json_values(io.StringIO('123456, 7.25e3 ,8'), chunk_size=2)), [123456, 7250.0, 8])
+
+    def test_malformed_document(self):
+        with self.assertRaises(ValueError):
+            list(iter_geojson_features(io.StringIO('[{"type": "Feature"}]')))
+
+    def test_error_position_is_in_file(self):
+        text = '1, 2, 3, {"name": "' + 'x' * 50 + '", "value": }'
+        with self.assertRaisesRegex(ValueError, f'position {text.index("}")}$'):
+            list(iter_json_values(io.StringIO(text), chunk_size=4))
+        with self.assertRaisesRegex(ValueError, "Expected '{' at position 4,"):
+            list(iter_geojson_features(io.StringIO(' ' * 4 + '[]'), chunk_size=2))
+
+    def test_large_value_is_decoded_a_few_times(self):
+        feature = {'type': 'Feature', 'properties': {'name': 'x' * 100000}, 'geometry': None}
+        decoder = mock.Mock(wraps=json.JSONDecoder())
+        with mock.patch('maps_app.geojson_stream.DECODER', decoder):
+            self.assertEqual(list(iter_json_values(io.StringIO(json.dumps(feature)), chunk_size=64)), [feature])
+        # Без роста буфера вдвое разбор повторялся бы после каждого из полутора тысяч кусков
+        self.assertLess(decoder.raw_decode.call_count, 20)
+
+
+class UploadChunksTests(SimpleTestCase):
+    def test_features_start(self):
+        collection = make_collection(3)
+        text = json.dumps(collection, ensure_ascii=False)
+        start = find_features_start(io.StringIO(text), chunk_size=4)
+        self.assertEqual(next(iter_json_values(io.StringIO(text[start:]))), collection['features'][0])
+        self.assertIsNone(find_features_start(io.StringIO('{"name": "x", "features": [ ]}')))
+        self.assertIsNone(find_features_start(io.StringIO('{"name": "x"}')))
+
+    def test_geojson_chunks_hold_all_features(self):
+        collection = make_collection(200)
+        for prefix in ('', '﻿'):
+            raw = (prefix + json.dumps(collection, ensure_ascii=False, indent=2)).encode()
+            for block_size in (3, 64, 1024 * 1024):
+                with mock.patch('maps_app.upload_chunks.SCAN_BLOCK_SIZE', block_size):
+                    chunks = plan_geojson_chunks(io.BytesIO(raw), 2000)
+                self.assertGreater(len(chunks), 1)
+                features = []
+                for ranges in chunks:
+                    features.extend(iter_json_values(io.StringIO(read_ranges(raw, ranges, 'utf-8'))))
+                self.assertEqual(features, collection['features'])
+
+    def test_geojson_chunk_per_feature(self):
+        collection = make_collection(20)
+        raw = json.dumps(collection, ensure_ascii=False).encode()
+        self.assertEqual(len(plan_geojson_chunks(io.BytesIO(raw), 1)), 20)
+        self.assertEqual(len(plan_geojson_chunks(io.BytesIO(raw), len(raw))), 1)
+
+    def test_geojson_without_features(self):
+        self.assertEqual(plan_geojson_chunks(io.BytesIO(b'{"type": "FeatureCollection", "features": []}'), 10), [])
+
+    def test_unclosed_geojson(self):
+        with self.assertRaises(ValueError):
+            plan_geojson_chunks(io.BytesIO(b'{"features": [{"a": "]"}, {"b": 1}'), 10)
+
+    def test_csv_chunks_keep_quoted_line_breaks(self):
+        rows = [[str(i), f'строка\r\nс "кавычками" {i}' if i % 3 else 'простая', str(i * 2)] for i in range(300)]
+        text = io.StringIO()
+        csv.writer(text).writerows([['id', 'text', 'value']] + rows)
+        raw = ('﻿' + text.getvalue()).encode()
+        for block_size in (5, 1024 * 1024):
+            with mock.patch('maps_app.upload_chunks.SCAN_BLOCK_SIZE', block_size):
+                file = io.BytesIO(raw)
+                chunks = plan_csv_chunks(file, len(raw), 1000)
+            self.assertGreater(len(chunks), 1)
+            parsed = []
+            for ranges in chunks:
+                header, *chunk_rows = csv.reader(io.StringIO(read_ranges(raw, ranges)))
+                self.assertEqual(header, ['id', 'text', 'value'])
+                parsed.extend(chunk_rows)
+            self.assertEqual(parsed, rows)
+
+
+class FairOrderTests(SimpleTestCase):
+    def test_round_robin_between_companies(self):
+        start = datetime(2024, 1, 1)
+
+        def task(name, company, minutes):
+            return SimpleNamespace(name=name, company_id=company, created_at=start + timedelta(minutes=minutes))
+
+        pending = [task('a1', 'a', 1), task('a2', 'a', 2), task('b1', 'b', 3), task('a3', 'a', 4), task('c1', 'c', 5)]
+        # У компании b уже идёт расчет, поэтому её очередь после a и c
+        ordered = fair_order(pending, Counter({'b': 1}))
+        self.assertEqual([task.name for task in ordered], ['a1', 'c1', 'b1', 'a2', 'a3'])
+
+    def test_empty_queue(self):
+        self.assertEqual(fair_order([], Counter()), [])
+
+
+class GrantScoringSlotsTests(TestCase):
+    def setUp(self):
+        self.companies = {name: Company.objects.create(name=name) for name in ('a', 'b')}
+        self.creator = User.objects.create(email='creator@example.com', username='creator')
+
+    def create_task(self, company, status='pending'):
+        layer = MapLayer.objects.create(name=f'layer {company}', creator=self.creator)
+        return CreateScoringMapLayerTask.objects.create(task_id='', layer=layer, company=self.companies[company],
+                                                        status=status)
+
+    @override_settings(SCORING_MAX_CONCURRENT_TASKS=3, SCORING_MAX_TASKS_PER_COMPANY=2)
+    def test_global_limit(self):
+        self.create_task('a', status='in_progress')
+        a_tasks = [self.create_task('a') for _ in range(3)]
+        b_tasks = [self.create_task('b') for _ in range(2)]
+
+        started = grant_scoring_slots()
+
+        self.assertEqual(started, [b_tasks[0], a_tasks[0]])
+        self.assertEqual(CreateScoringMapLayerTask.objects.filter(status='in_progress').count(), 3)
+        self.assertTrue(all(task.started_at is not None for task in started))
+
+    @override_settings(SCORING_MAX_CONCURRENT_TASKS=5, SCORING_MAX_TASKS_PER_COMPANY=2)
+    def test_company_limit(self):
+        self.create_task('a', status='in_progress')
+        a_tasks = [self.create_task('a') for _ in range(3)]
+        b_task = self.create_task('b')
+
+        started = grant_scoring_slots()
+
+        self.assertEqual(started, [b_task, a_tasks[0]])
+        a_tasks[1].refresh_from_db()
+        self.assertEqual(a_tasks[1].status, 'pending')
+
+    @override_settings(SCORING_MAX_CONCURRENT_TASKS=3, SCORING_MAX_TASKS_PER_COMPANY=2)
+    def test_tasks_without_layer_are_skipped(self):
+        task = self.create_task('a')
+        task.layer.delete()
+
+        self.assertEqual(grant_scoring_slots(), [])
+
+
+class RingsToHexEwkbTests(SimpleTestCase):
+    def test_matches_shapely(self):
+        rings = [
+            [(0, 0), (1, 0), (0, 1), (0, 0)],
+            [(10.5, 10), (11, 10), (11, 11.25), (10, 11), (10.5, 10)],
+            [(-5, -5), (-4, -5), (-5, -4), (-5, -5)],
+        ]
+        coords = np.array([point for ring in rings for point in ring], dtype=np.float64)
+        offsets = np.cumsum([0] + [len(ring) for ring in rings])
+
+        result = rings_to_hex_ewkb(coords, offsets, srid=4326)
+
+        polygons = shapely.set_srid(shapely.polygons([shapely.linearrings(ring) for ring in rings]), 4326)
+        expected = shapely.to_wkb(polygons, hex=True, include_srid=True, byte_order=1)
+        self.assertEqual([value.lower() for value in expected.tolist()], result.tolist())
+
+    def test_empty(self):
+        self.assertEqual(len(rings_to_hex_ewkb(np.empty((0, 2)), np.array([0]))), 0)
+
+
+class CsvPropertiesTests(SimpleTestCase):
+    def test_line_separators_inside_values(self):
+        values = ['a\u2028b', 'c\u2029d', 'e\x85f', 'g\x1ch', 'i\vj\fk', 'l\r\nm', '']
+        chunk = pd.DataFrame({'name': values, 'value': [str(i) for i in range(len(values))]})
+
+        properties = get_csv_properties(chunk)
+
+        self.assertEqual([json.loads(value) for value in properties], chunk.to_dict('records'))
+
+    def test_without_columns(self):
+        self.assertEqual(get_csv_properties(pd.DataFrame(index=range(2))), ['{}', '{}'])
+        self.assertEqual(get_csv_properties(pd.DataFrame({'name': []})), [])
+
+
+class FeatureColumnsTests(SimpleTestCase):
+    def test_copy_rejects_uneven_columns(self):
+        with self.assertRaises(ValueError):
+            copy_feature_rows(None, 1, 'Feature', ['{}', '{}'], ['01'])
+        with self.assertRaises(ValueError):
+            copy_feature_rows(None, 1, ['Feature'], ['{}', '{}'], ['01', '02'])
+        with self.assertRaises(ValueError):
+            copy_feature_rows(None, 1, 'Feature', ['{}'], ['01'], [1, 2])
+
+    def test_loader_rejects_uneven_columns(self):
+        loader = FeatureLoader(1, chunk_size=10, transaction_scope='chunk')
+        loader.add('Feature', ['{}'], ['01'], [1])
+        with self.assertRaises(ValueError):
+            loader.add('Feature', ['{}', '{}'], ['01'])
+        self.assertEqual(loader.columns, (['Feature'], ['{}'], ['01'], [1]))
+
+
+class NormalizeByGroupTests(SimpleTestCase):
+    def test_scores_are_scaled_within_groups(self):
+        grid = pd.DataFrame({'city_name': ['a', 'a', 'b', 'b', None], 'score': [5., 10., 0., 0., 3.]})
+        maximums = grid.groupby('city_name', dropna=False)['score'].transform('max').to_numpy()
+        # Нормализация повторяет np.interp(score, [0, max], [0, 100]), в том числе при нулевом максимуме
+        expected = [np.interp(score, [0, maximum], [0, 100]) for score, maximum in zip(grid['score'], maximums)]
+
+        result = normalize_by_group(grid.copy(), 'city_name')
+
+        np.testing.assert_allclose(result['score'].to_numpy(), expected)
+        np.testing.assert_allclose(result['score'].to_numpy(), [50., 100., 100., 100., 100.])
+
+
+class DeleteOutdatedGridCellsTests(TestCase):
+    def test_referenced_and_current_versions_are_kept(self):
+        creator = User.objects.create(email='creator@example.com', username='creator')
+        MapLayer.objects.create(name='old scores', creator=creator, storage='grid_scores', grid_version='old')
+        MapLayer.objects.create(name='features', creator=creator, grid_version='stale')
+        for version in ('old', 'stale', 'unused', 'current'):
+            GridCell.objects.bulk_create([
+                GridCell(grid_version=version, cell_id=cell_id, geometry=Point(cell_id, 0, srid=4326))
+                for cell_id in range(3)
+            ])
+
+        self.assertEqual(delete_outdated_grid_cells(['current']), 6)
+        self.assertEqual(set(GridCell.objects.values_list('grid_version', flat=True)), {'old', 'current'})
+
+
+class VectorizedScoringTests(SimpleTestCase):
+    polygon_radius = 50
+    poi_list = {'shops': {'max-distance': 150, 'max-score': 10}, 'cafes': {'max-distance': 100, 'max-score': 4}}
+
+    def get_snapshots(self):
+        rng = np.random.default_rng(1)
+        center = (250, 150)
+        border = ring_points(center, 200, [0.9975, 0.999, 1.001]) + ring_points(center, 150, [0.999, 0.9995])
+        return {
+            'shops': make_snapshot('shops', np.vstack([rng.uniform(-200, 700, (60, 2)), border])),
+            'cafes': make_snapshot('cafes', np.vstack([rng.uniform(0, 500, (30, 2)), ring_points(center, 150,
+                                                                                                  [0.999])])),
+        }
+
+    def test_matches_reference(self):
+        snapshots = self.get_snapshots()
+        with mock.patch('maps_app.utils.load_poi_snapshot', lambda engine, poi: snapshots[poi]):
+            expected = calculate_scoring(None, make_grid(5, 3), self.poi_list, self.polygon_radius, TransientTask())
+            grid = make_grid(5, 3)
+            task = TransientTask()
+            result = apply_primary_scores(grid, self.poi_list, iter_primary_scores_vectorized(
+                None, grid, self.poi_list, self.polygon_radius, task), task)
+
+        for column in ('shops', 'cafes', 'score'):
+            np.testing.assert_allclose(result[column].to_numpy(), expected[column].to_numpy(dtype=float))
+        self.assertGreater(expected['score'].max(), 0)
+
+    def test_border_pairs_follow_buffer_polygon(self):
+        centroid, radius = np.array([(0., 0.)]), 100.
+        points = ring_points((0, 0), radius, [cos(pi / 64) * 0.999, 0.9995, 1.0005])
+        geometries = shapely.points(np.asarray(points))
+
+        cell_idx, distances = find_poi_neighbors(shapely.points(centroid), geometries, radius)
+
+        buffer = shapely.points(centroid)[0].buffer(radius)
+        expected = [shapely.distance(point, shapely.points(centroid)[0])
+                    for point in geometries if buffer.intersects(point)]
+        np.testing.assert_allclose(np.sort(distances), np.sort(expected))
+        # Внутри вписанной окружности все 8 точек, у радиуса - только 4 на лучах к вершинам буфера
+        self.assertEqual(len(distances), 12)
+        self.assertTrue((cell_idx == 0).all())
+
+
+class H3NeighborsTests(SimpleTestCase):
+    resolution = 9
+
+    def test_ring_covers_radius(self):
+        for lat in (0, 55.75, 69.5):
+            for radius in (300, 1500):
+                cell = h3.geo_to_h3(lat, 37.6, self.resolution)
+                center = get_h3_centers([cell])[0]
+                k = get_ring_size(self.resolution, radius, np.array([center[1]]))
+                ring = set(h3.k_ring(cell, k))
+                # Ячейки с центром в радиусе от любой точки ячейки, с запасом на ребро ячейки
+                candidates = np.array(sorted(h3.k_ring(cell, 2 * k + 2)))
+                distances = np.hypot(*(get_h3_centers(candidates) - center).T)
+                edge = h3.edge_length(self.resolution, unit='m') / np.cos(np.radians(lat))
+                within = candidates[distances <= radius + edge]
+                self.assertTrue(set(within.tolist()) <= ring, (lat, radius))
+
+    def test_neighbors_match_brute_force(self):
+        center_cell = h3.geo_to_h3(55.75, 37.6, self.resolution)
+        grid_cells = np.array(sorted(h3.k_ring(center_cell, 15)), dtype=np.int64)
+        centroids = get_h3_centers(grid_cells)
+        rng = np.random.default_rng(2)
+        points = centroids.mean(axis=0) + rng.uniform(-1500, 1500, (200, 2))
+        buckets = get_poi_buckets(make_snapshot('h3_neighbors_test', points), self.resolution)
+        radius = 900
+
+        found = [np.column_stack(pair) for pair in iter_h3_neighbors(grid_cells, centroids, buckets, radius)]
+        found = np.vstack(found)
+
+        distances = np.hypot(centroids[:, None, 0] - buckets.coords[None, :, 0],
+                             centroids[:, None, 1] - buckets.coords[None, :, 1])
+        cell_idx, _ = np.nonzero(distances <= radius)
+        expected = np.column_stack([cell_idx, distances[distances <= radius]])
+        self.assertGreater(len(expected), len(points))
+        np.testing.assert_allclose(found[np.lexsort(found.T[::-1])], expected[np.lexsort(expected.T[::-1])])
+
+
+@override_settings(SCORING_GRID_PATH='grid.gpkg', SCORING_FFT_PIXEL_SIZE=25)
+class ScoringCacheKeyTests(SimpleTestCase):
+    poi_data = [
+        {'name': 'shops', 'max_score': 10, 'max_distance': 500, 'is_active': True},
+        {'name': 'cafes', 'max_score': '4', 'max_distance': '300', 'is_active': True},
+        {'name': 'banks', 'max_score': 1, 'max_distance': 100, 'is_active': False},
+    ]
+
+    def setUp(self):
+        self.snapshot_versions = {'shops': '10-1', 'cafes': '20-2', 'banks': None}
+        patches = [
+            mock.patch('maps_app.utils.get_grid_version', lambda path: 'grid-sha'),
+            mock.patch('maps_app.utils.get_poi_snapshot_version', lambda poi: self.snapshot_versions[poi]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get_key(self, backend='vectorized', poi_data=None, region=None, h3_resolution=8):
+        return get_scoring_cache_key(poi_data or self.poi_data, 50, 'city', backend, h3_resolution, region)
+
+    def test_key_is_stable(self):
+        key = self.get_key()
+        self.assertIsNotNone(key)
+        self.assertEqual(self.get_key(poi_data=self.poi_data[::-1]), key)
+        self.assertEqual(self.get_key(poi_data=self.poi_data[:2]), key)
+        self.assertEqual(self.get_key(region={'cities': [], 'bbox': None}), key)
+        self.assertEqual(self.get_key(region={'cities': ['b', 'a']}), self.get_key(region={'cities': ['a', 'b']}))
+        # Точные движки считают одни и те же баллы
+        for backend in ('reference', 'parallel', 'distributed'):
+            self.assertEqual(self.get_key(backend), key)
+        self.assertEqual(self.get_key(h3_resolution=9), key)
+
+    def test_output_classes_are_kept_apart(self):
+        keys = {self.get_key(backend) for backend in ('vectorized', 'low_memory', 'fft', 'h3')}
+        self.assertEqual(len(keys), 4)
+        self.assertNotEqual(self.get_key('h3', h3_resolution=9), self.get_key('h3'))
+        self.assertNotEqual(self.get_key(region={'cities': ['a']}), self.get_key())
+        fft_key = self.get_key('fft')
+        with override_settings(SCORING_FFT_PIXEL_SIZE=50):
+            self.assertNotEqual(self.get_key('fft'), fft_key)
+
+    def test_inputs_change_the_key(self):
+        key = self.get_key()
+        poi_data = [dict(self.poi_data[0], max_score=11)] + self.poi_data[1:]
+        self.assertNotEqual(self.get_key(poi_data=poi_data), key)
+        self.assertNotEqual(get_scoring_cache_key(self.poi_data, 60, 'city', 'vectorized', 8), key)
+        self.assertNotEqual(get_scoring_cache_key(self.poi_data, 50, 'global', 'vectorized', 8), key)
+        self.snapshot_versions['shops'] = '11-1'
+        self.assertNotEqual(self.get_key(), key)
+
+    def test_no_key_without_versions(self):
+        self.assertIsNone(self.get_key('sql'))
+        self.snapshot_versions['cafes'] = None
+        self.assertIsNone(self.get_key())
+
+
+@override_settings(SCORING_PRIMARY_CACHE=True)
+class PrimaryScoresCacheTests(SimpleTestCase):
+    poi_list = {'shops': {'max-distance': 500, 'max-score': 10}, 'cafes': {'max-distance': 300, 'max-score': 4}}
+
+    def setUp(self):
+        self.cache_dir = use_temp_cache_dir(self)
+        self.snapshot_versions = {'shops': '10-1', 'cafes': '20-2'}
+        patches = [
+            mock.patch('maps_app.score_cache.get_grid_version', lambda path: 'a' * 64),
+            mock.patch('maps_app.score_cache.get_poi_snapshot_version', lambda poi: self.snapshot_versions[poi]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.grid = pd.DataFrame({'score': np.zeros(4)})
+        self.computed = []
+
+    def compute(self, engine, grid, poi_list, polygon_radius, task):
+        for poi in poi_list:
+            self.computed.append(poi)
+            yield poi, np.full(len(grid), len(self.computed), dtype=np.float64)
+
+    def get_scores(self, poi_list=None, polygon_radius=50):
+        task = TransientTask()
+        scores = dict(iter_primary_scores_cached(self.compute, None, self.grid, poi_list or self.poi_list,
+                                                 polygon_radius, task))
+        return scores, [stage['category'] for stage in task.metrics['stages'] if stage['name'] == 'primary_cache_hit']
+
+    def test_hit_and_miss(self):
+        first, hits = self.get_scores()
+        self.assertEqual((self.computed, hits), (['shops', 'cafes'], []))
+
+        # Макс. балл на первичные баллы не влияет, кэш годится
+        poi_list = {poi: {**params, 'max-score': 1} for poi, params in self.poi_list.items()}
+        second, hits = self.get_scores(poi_list)
+        self.assertEqual((self.computed, sorted(hits)), (['shops', 'cafes'], ['cafes', 'shops']))
+        for poi in self.poi_list:
+            np.testing.assert_array_equal(second[poi], first[poi])
+
+        self.get_scores(polygon_radius=60)
+        self.assertEqual(self.computed[2:], ['shops', 'cafes'])
+
+    def test_stale_snapshot_versions_are_removed(self):
+        self.get_scores()
+        self.snapshot_versions['shops'] = '11-1'
+        _, hits = self.get_scores()
+        self.assertEqual((self.computed[2:], hits), (['shops'], ['cafes']))
+
+        shops_files = []
+        for root, _, names in os.walk(self.cache_dir):
+            if os.path.basename(root) == 'shops':
+                shops_files.extend(names)
+        self.assertEqual(shops_files, ['11-1_500_50.npy'])
+
+
+class SavedTask(TransientTask):
+    # Задача с записью в базе: контрольные точки сохраняются, сама запись в тестах не нужна
+    pk = 7
+
+    def __init__(self):
+        super().__init__()
+        self.saves = 0
+
+    def save(self, *args, **kwargs):
+        self.saves += 1
+
+
+@override_settings(SCORING_PRIMARY_CACHE=False)
+class CheckpointTests(SimpleTestCase):
+    def setUp(self):
+        self.cache_dir = use_temp_cache_dir(self)
+        self.snapshot_versions = {'shops': '10-1', 'cafes': '20-2'}
+        patch = mock.patch('maps_app.checkpoints.get_poi_snapshot_version', lambda poi: self.snapshot_versions[poi])
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_save_and_restore(self):
+        task = SavedTask()
+        scores_pp = np.array([0., 1.5, 2.])
+        save_category_checkpoint(task, 'shops', 500, 50, scores_pp)
+        self.assertEqual(task.saves, 1)
+
+        np.testing.assert_array_equal(load_category_checkpoint(task, 'shops', 500, 50, 3), scores_pp)
+        self.assertIsNone(load_category_checkpoint(task, 'shops', 400, 50, 3))
+        self.assertIsNone(load_category_checkpoint(task, 'shops', 500, 60, 3))
+        self.assertIsNone(load_category_checkpoint(task, 'shops', 500, 50, 4))
+        self.assertIsNone(load_category_checkpoint(task, 'cafes', 300, 50, 3))
+        self.snapshot_versions['shops'] = '11-1'
+        self.assertIsNone(load_category_checkpoint(task, 'shops', 500, 50, 3))
+
+    def test_tasks_without_record_are_not_checkpointed(self):
+        task = TransientTask()
+        save_category_checkpoint(task, 'shops', 500, 50, np.zeros(3))
+        save_import_checkpoint(task, 10, 100)
+        self.assertEqual(task.checkpoint, {})
+        self.assertFalse(os.listdir(self.cache_dir))
+
+    def test_import_offset(self):
+        task = SavedTask()
+        save_import_checkpoint(task, 100, 1000)
+        self.assertEqual(get_import_offset(task, 1000), 100)
+        # Сетка другого размера - импорт начинается заново
+        self.assertEqual(get_import_offset(task, 999), 0)
+
+    def test_clear(self):
+        task = SavedTask()
+        save_category_checkpoint(task, 'shops', 500, 50, np.zeros(3))
+        save_import_checkpoint(task, 100, 1000)
+        clear_checkpoint(task)
+        self.assertEqual(task.checkpoint, {})
+        self.assertIsNone(load_category_checkpoint(task, 'shops', 500, 50, 3))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'checkpoints', '7')))
+
+    def test_resume_computes_only_missing_categories(self):
+        poi_list = {'shops': {'max-distance': 500, 'max-score': 10}, 'cafes': {'max-distance': 300, 'max-score': 4}}
+        grid = pd.DataFrame({'score': np.zeros(3)})
+        task = SavedTask()
+        save_category_checkpoint(task, 'shops', 500, 50, np.ones(3))
+        save_import_checkpoint(task, 2, 3)
+        computed = []
+
+        def compute(engine, grid, poi_list, polygon_radius, task):
+            for poi in poi_list:
+                computed.append(poi)
+                yield poi, np.full(len(grid), 2.)
+
+        scores = dict(iter_primary_scores_resumable(compute, None, grid, poi_list, 50, task))
+
+        self.assertEqual(computed, ['cafes'])
+        np.testing.assert_array_equal(scores['shops'], np.ones(3))
+        # Часть категорий посчитана заново, импорт объектов начнётся сначала
+        self.assertEqual(get_import_offset(task, 3), 0)
+        np.testing.assert_array_equal(load_category_checkpoint(task, 'cafes', 300, 50, 3), np.full(3, 2.))
+
+
+class RegionTests(SimpleTestCase):
+    def test_clip_grid_to_cities_and_bbox(self):
+        grid = make_grid(5, 3)
+        # 0.0025 градуса у экватора - около 278 м: в охват попадают центры трёх левых столбцов
+        region = {'cities': ['a'], 'bbox': [0, 0, 0.0025, 0.0025]}
+
+        clipped = clip_grid_to_region(grid, region)
+
+        centroids = grid.geometry.centroid
+        expected = grid[(grid['city_name'] == 'a') & (centroids.x <= 278) & (centroids.y <= 278)]
+        self.assertEqual(clipped.index.tolist(), expected.index.tolist())
+        self.assertEqual(len(clipped), 4)
+        self.assertEqual(clipped.attrs['region'], get_region_key(region))
+        # Колонки задачи пишутся в копию, общая сетка не меняется
+        clipped['score'] = 1.
+        self.assertEqual(grid['score'].sum(), 0)
+
+    def test_empty_region_keeps_grid(self):
+        grid = make_grid(2, 2)
+        self.assertIs(clip_grid_to_region(grid, None), grid)
+        self.assertIs(clip_grid_to_region(grid, {'cities': [], 'bbox': None}), grid)
+        self.assertEqual(len(clip_grid_to_region(grid, {'cities': ['c']})), 0)
+
+    def test_poi_in_reach(self):
+        snapshot = make_snapshot('region_test', [(0, 0), (90, 90), (250, 0), (1000, 1000)])
+
+        geometries, tree = get_poi_in_reach(snapshot, (0, 0, 100, 100), 150)
+        self.assertEqual(shapely.get_coordinates(geometries).tolist(), [[0, 0], [90, 90], [250, 0]])
+        self.assertEqual(len(tree), 3)
+
+        geometries, tree = get_poi_in_reach(snapshot, (0, 0, 100, 100), 2000)
+        self.assertIs(geometries, snapshot.geometries)
+        self.assertIs(tree, snapshot.tree)
+
+        geometries, tree = get_poi_in_reach(snapshot, None, 150)
+        self.assertEqual((len(geometries), tree), (0, None))
+
+
+class PartitionsTests(SimpleTestCase):
+    def make_cities_grid(self):
+        # Большой город на 24 ячейки и три маленьких по 2 ячейки правее
+        grid = make_grid(10, 3)
+        grid['city_name'] = ['big' if i % 10 < 8 else f'small{i // 10}' for i in range(len(grid))]
+        return grid
+
+    def test_parts_cover_grid(self):
+        grid = self.make_cities_grid()
+        for pack_cities in (True, False):
+            parts = split_grid_positions(grid, 5, pack_cities=pack_cities)
+            self.assertEqual(sorted(np.concatenate(parts).tolist()), list(range(len(grid))))
+            self.assertTrue(all(0 < len(part) <= 5 for part in parts))
+
+        parts = split_grid_positions(grid, 5)
+        cities = [set(grid['city_name'].iloc[part]) for part in parts]
+        # Большой город режется на части без примеси других, маленькие соседние упаковываются вместе
+        self.assertIn({'small0', 'small1'}, cities)
+        self.assertEqual(sum(len(part) for part, city in zip(parts, cities) if city == {'big'}), 24)
+        unpacked = [set(grid['city_name'].iloc[part]) for part in split_grid_positions(grid, 5, pack_cities=False)]
+        self.assertTrue(all(len(city) == 1 for city in unpacked))
+
+    def test_parts_are_compact(self):
+        grid = make_grid(8, 8)
+        grid['city_name'] = 'a'
+        coords = np.column_stack([grid.geometry.centroid.x, grid.geometry.centroid.y])
+        for part in split_grid_positions(grid, 16):
+            self.assertEqual(len(part), 16)
+            self.assertLessEqual(np.ptp(coords[part], axis=0).max(), 300)
+
+    def test_merge_by_labels(self):
+        use_temp_cache_dir(self)
+        grid = self.make_cities_grid()
+        grid.index = np.arange(len(grid))[::-1] * 3 + 100
+        task = SavedTask()
+        partitions = split_grid_partitions(grid, 5)
+        plan = save_partition_plan(task, partitions, len(grid))
+        for index, labels in enumerate(partitions):
+            save_partition_scores(task, index, {'shops': labels * 2., 'cafes': labels + 0.5})
+
+        merged = dict(iter_merged_primary_scores(task, plan, grid, ['shops', 'cafes']))
+
+        np.testing.assert_array_equal(merged['shops'], grid.index.to_numpy() * 2.)
+        np.testing.assert_array_equal(merged['cafes'], grid.index.to_numpy() + 0.5)
+
+
+@override_settings(SCORING_PRIMARY_CACHE=False, SCORING_CHUNK_CELLS=7, SCORING_MEMORY_BUDGET_MB=2048)
+class LowMemoryScoringTests(SimpleTestCase):
+    poi_list = {'shops': {'max-distance': 300, 'max-score': 10}, 'cafes': {'max-distance': 150, 'max-score': 4}}
+
+    def test_matches_vectorized_within_float32(self):
+        rng = np.random.default_rng(3)
+        snapshots = {poi: make_snapshot(poi, rng.uniform(-300, 1500, (count, 2)))
+                     for poi, count in (('shops', 400), ('cafes', 50))}
+        with mock.patch('maps_app.utils.load_poi_snapshot', lambda engine, poi: snapshots[poi]):
+            expected = calculate_scoring_vectorized(None, make_grid(12, 9), self.poi_list, 50, TransientTask())
+            task = TransientTask()
+            result = calculate_scoring_low_memory(None, make_grid(12, 9), self.poi_list, 50, task)
+
+        # Итоговый балл во float32: относительная погрешность порядка машинного эпсилон float32
+        np.testing.assert_allclose(result['score'].to_numpy(), expected['score'].to_numpy(), rtol=1e-5, atol=1e-5)
+        self.assertNotIn('shops', result)
+        # Сетка из 108 ячеек считается фрагментами по SCORING_CHUNK_CELLS
+        chunks = [stage['chunks'] for stage in task.metrics['stages'] if stage['name'] == 'neighbor_search']
+        self.assertEqual(chunks, [16, 16])
+
+
+@override_settings(SCORING_FFT_TILE_CELLS=40)
+class FftScoringTests(SimpleTestCase):
+    poi_list = {'shops': {'max-distance': 200, 'max-score': 10}}
+    polygon_radius = 50
+
+    def get_primary_scores(self, iter_primary_scores, grid, snapshot):
+        with mock.patch('maps_app.utils.load_poi_snapshot', lambda engine, poi: snapshot):
+            return dict(iter_primary_scores(None, grid, self.poi_list, self.polygon_radius, TransientTask()))['shops']
+
+    def test_error_bound(self):
+        grid = make_grid(12, 8)
+        rng = np.random.default_rng(4)
+        # Скопление точек и пустая область справа, где баллы должны остаться нулевыми
+        coords = np.vstack([rng.uniform(0, 500, (300, 2)), rng.normal(300, 40, (200, 2))])
+        snapshot = make_snapshot('fft_test', coords)
+        exact = self.get_primary_scores(iter_primary_scores_vectorized, grid, snapshot)
+        centroids = np.column_stack([grid.geometry.centroid.x, grid.geometry.centroid.y])
+        distances = np.hypot(centroids[:, None, 0] - coords[None, :, 0], centroids[:, None, 1] - coords[None, :, 1])
+        max_distance = self.poi_list['shops']['max-distance']
+
+        errors = {}
+        for pixel in (5, 20):
+            with override_settings(SCORING_FFT_PIXEL_SIZE=pixel):
+                approximate = self.get_primary_scores(iter_primary_scores_fft, grid, snapshot)
+            errors[pixel] = np.abs(approximate - exact).max()
+            # Ядро линейно убывает с наклоном 1 / max-distance, растр и билинейная выборка сдвигают каждую
+            # точку не больше чем на pixel * sqrt(2), а буфер центроиды отличается от круга меньше чем на 0.2%
+            reach = (distances <= max_distance + self.polygon_radius + 2 * pixel).sum(axis=1)
+            bound = reach * (pixel * np.sqrt(2) / max_distance + 2e-3)
+            self.assertTrue((np.abs(approximate - exact) <= bound + 1e-9).all(), pixel)
+            out_of_reach = reach == 0
+            self.assertTrue(out_of_reach.any())
+            self.assertTrue((approximate[out_of_reach] == 0).all())
+
+        # Погрешность растёт с размером пикселя
+        self.assertLess(errors[5], errors[20])
+        self.assertLess(errors[20] / exact.max(), 0.01)
+
+
+class CopyCursor:
+    # Курсор, который только запоминает данные COPY
+    def __init__(self):
+        self.copied = []
+
+    def copy_expert(self, sql, file):
+        self.copied.append((sql, file.read()))
+
+
+class GridScoresTests(SimpleTestCase):
+    def test_property_lookups(self):
+        layer = MapLayer(id=1, storage='grid_scores', score_fields=['shops', 'cafes'])
+
+        queryset, lookup = get_layer_property_lookup(layer, 'score')
+        self.assertEqual((queryset.model, lookup), (ScoringCellScore, 'score'))
+        queryset, lookup = get_layer_property_lookup(layer, 'cafes')
+        self.assertEqual((queryset.model, lookup), (ScoringCellScore, 'poi_scores__1'))
+        # Свойства, которого нет у ячеек, нет ни у одного объекта слоя
+        queryset, lookup = get_layer_property_lookup(layer, 'name')
+        self.assertTrue(queryset.query.is_empty())
+
+        queryset, lookup = get_layer_property_lookup(MapLayer(id=2, storage='features'), 'cafes')
+        self.assertEqual((queryset.model, lookup), (Feature, 'properties__cafes'))
+
+    def test_cell_properties(self):
+        cell_score = ScoringCellScore(cell_id=5, score=7.5, poi_scores=[5., 2.5])
+        self.assertEqual(get_cell_properties(cell_score, ['shops', 'cafes']), {'score': 7.5, 'shops': 5., 'cafes': 2.5})
+
+    def test_copy_rows(self):
+        cursor = CopyCursor()
+        copy_grid_cells(cursor, 'h3', np.array([11, 12]), ['0103', '0104'])
+        copy_cell_scores(cursor, 3, np.array([11, 12]), np.array([1.5, 0.]), np.array([[1., 0.5], [0., 0.]]))
+
+        self.assertEqual(cursor.copied[0][1], 'h3\t11\t0103\nh3\t12\t0104\n')
+        self.assertEqual(cursor.copied[1][1], '3\t11\t1.5\t{1.0,0.5}\n3\t12\t0.0\t{0.0,0.0}\n')
@@ -0,0 +1,134 @@
+import codecs
+import io
+
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from maps_app.geojson_stream import find_features_start
+
+# Файл при разбиении читается блоками по столько байт
+SCAN_BLOCK_SIZE = 1024 * 1024
+QUOTE, BACKSLASH, COMMA = b'"\\,'
+# Изменение вложенности по байту: скобки открывают и закрывают объекты и массивы
+BRACKET_STEPS = np.zeros(256, dtype=np.int8)
+BRACKET_STEPS[list(b'{[')] = 1
+BRACKET_STEPS[list(b'}]')] = -1
+
+
+def plan_csv_chunks(file, size, chunk_bytes):
+    """
+    Cuts a CSV into byte ranges of about chunk_bytes at line ends outside of quoted values.
+    Every chunk is read as the header line followed by its range.
+    """
+    header_end = len(file.readline())
+    boundaries = [header_end]
+    target = header_end + chunk_bytes
+    position, quotes = header_end, 0
+    for block in iter(lambda: file.read(SCAN_BLOCK_SIZE), b''):
+        end = position + len(block)
+        while target < end:
+            newline = block.find(b'\n', max(target - position, 0))
+            if newline == -1:
+                break
+            target = position + newline + 1
+            # Нечётное число кавычек до перевода строки - он внутри значения
+            if (quotes + block.count(b'"', 0, newline)) % 2 == 0:
+                boundaries.append(target)
+                target += chunk_bytes
+        quotes += block.count(b'"')
+        position = end
+
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return [[(0, header_end), (start, end)] for start, end in zip(boundaries, boundaries[1:])]
+
+
+def find_string_quotes(data, backslashes):
+    """
+    Mask of the quotes of a block that open or close strings. A quote is escaped by an odd number
+    of backslashes before it, `backslashes` is their number at the end of the previous block.
+    Returns the mask and the number of backslashes at the end of this block.
+    """
+    quotes = data == QUOTE
+    if backslashes % 2:
+        quotes[0] = False
+    slashes = np.flatnonzero(data == BACKSLASH)
+    if not len(slashes):
+        return quotes, 0
+    # Для каждой обратной косой черты - длина серии до неё включительно
+    index = np.arange(len(slashes))
+    run_starts = np.maximum.accumulate(np.where(np.diff(slashes, prepend=-2) != 1, index, 0))
+    runs = index - run_starts + 1 + np.where(slashes[run_starts] == 0, backslashes, 0)
+    # Кавычка сразу после серии нечётной длины экранирована
+    escaped = slashes[runs % 2 == 1] + 1
+    quotes[escaped[escaped < len(data)]] = False
+    return quotes, int(runs[-1]) if slashes[-1] == len(data) - 1 else 0
+
+
+def plan_geojson_chunks(file, chunk_bytes):
+    """
+    Cuts the features array of a GeoJSON into byte ranges of about chunk_bytes at feature boundaries.
+    The array is scanned as bytes by numpy: only string quotes, brackets and commas are looked at,
+    features are not decoded.
+    """
+    # В latin-1 каждый байт - один символ, поэтому позиции разбора совпадают с байтовыми,
+    # а структурные символы JSON в UTF-8 не встречаются внутри многобайтовых последовательностей
+    bom = len(codecs.BOM_UTF8) if file.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 0
+    file.seek(bom)
+    text = io.TextIOWrapper(file, encoding='latin-1', newline='')
+    start = find_features_start(text)
+    text.detach()
+    if start is None:
+        return []
+
+    start += bom
+    file.seek(start)
+    cuts, end = [], None
+    target = start + chunk_bytes
+    # Состояние на границе блоков: вложенность внутри массива, открыта ли строка, обратные косые черты в конце
+    position, depth, in_string, backslashes = start, 0, 0, 0
+    for block in iter(lambda: file.read(SCAN_BLOCK_SIZE), b''):
+        data = np.frombuffer(block, dtype=np.uint8)
+        quotes, backslashes = find_string_quotes(data, backslashes)
+        # Символ вне строки, если до него чётное число кавычек с учетом открытой в прошлых блоках строки
+        outside = np.bitwise_xor.accumulate(quotes.view(np.uint8)) == in_string
+        steps = BRACKET_STEPS[data]
+        steps[~outside] = 0
+        depths = np.cumsum(steps, dtype=np.int32)
+        depths += depth
+        # Вложенность ниже нуля - закрылся сам массив объектов
+        closed = np.flatnonzero(depths < 0)
+        last = int(closed[0]) if len(closed) else len(data)
+        commas = position + np.flatnonzero((data[:last] == COMMA) & outside[:last] & (depths[:last] == 0))
+        while True:
+            index = np.searchsorted(commas, target)
+            if index == len(commas):
+                break
+            cuts.append(int(commas[index]))
+            target = cuts[-1] + 1 + chunk_bytes
+        if len(closed):
+            end = position + last
+            break
+        depth = int(depths[-1])
+        in_string = in_string ^ int(np.count_nonzero(quotes) % 2)
+        position += len(data)
+
+    if end is None:
+        raise ValueError('Features array of the GeoJSON is not closed')
+    return [[(chunk_start, chunk_end)] for chunk_start, chunk_end in zip([start] + [cut + 1 for cut in cuts],
+                                                                          cuts + [end])]
+
+
+def plan_upload_chunks(path, file_name):
+    """
+    Byte ranges of the chunks an upload is ingested by, None when the file is small enough
+    to be ingested by one task.
+    """
+    size = default_storage.size(path)
+    if size < settings.FEATURE_PARALLEL_MIN_BYTES:
+        return None
+    with default_storage.open(path, 'rb') as file:
+        if file_name.endswith('.csv'):
+            return plan_csv_chunks(file, size, settings.FEATURE_CHUNK_BYTES)
+        return plan_geojson_chunks(file, settings.FEATURE_CHUNK_BYTES)
@@ -0,0 +1,96 @@
+import codecs
+import hashlib
+import io
+import os
+from uuid import uuid4
+
+from django.core.files.storage import default_storage
+
+# Файлы слоёв лежат в общем хранилище только до конца импорта
+LAYER_UPLOADS_PATH = 'layer_uploads/'
+
+
+def get_file_checksum(file):
+    digest = hashlib.sha256()
+    for chunk in file.chunks() if hasattr(file, 'chunks') else iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def spool_layer_upload(uploaded_file):
+    """
+    Saves an uploaded layer file to the shared storage, returns its storage path and sha256.
+    Only the path goes through the broker, the worker reads the file from the storage.
+    """
+    checksum = get_file_checksum(uploaded_file)
+    uploaded_file.seek(0)
+    extension = os.path.splitext(uploaded_file.name)[-1].lower()
+    path = default_storage.save(os.path.join(LAYER_UPLOADS_PATH, f'{uuid4().hex}{extension}'), uploaded_file)
+    return path, checksum
+
+
+def verify_layer_upload(path, checksum):
+    # Проверяем, что в хранилище лежит именно загруженный файл
+    with default_storage.open(path, 'rb') as file:
+        if get_file_checksum(file) != checksum:
+            raise ValueError(f'Checksum mismatch for upload {path}')
+
+
+class RangeReader:
+    """
+    Text stream over byte ranges of a binary file, read one after another.
+    Ranges are cut at ASCII characters, multibyte characters inside a range are decoded incrementally.
+    """
+
+    def __init__(self, file, ranges, encoding='utf-8-sig'):
+        self.file = file
+        self.ranges = list(ranges)
+        self.remaining = 0
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+
+    def read(self, size=-1):
+        size = size if size and size > 0 else io.DEFAULT_BUFFER_SIZE
+        while True:
+            if self.remaining == 0:
+                if not self.ranges:
+                    return self.decoder.decode(b'', final=True)
+                start, end = self.ranges.pop(0)
+                self.file.seek(start)
+                self.remaining = end - start
+                continue
+            data = self.file.read(min(size, self.remaining))
+            if not data:
+                raise ValueError('Upload is shorter than the planned range')
+            self.remaining -= len(data)
+            # Пустая строка означает конец файла, поэтому неполный символ дочитываем
+            text = self.decoder.decode(data)
+            if text:
+                return text
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(lambda: self.read(), '')
+
+
+def open_layer_upload(path, ranges=None, encoding='utf-8-sig'):
+    """
+    Opens a spooled upload as a text stream, the whole file or only the given byte ranges.
+    """
+    file = default_storage.open(path, 'rb')
+    if ranges is not None:
+        return RangeReader(file, ranges, encoding)
+    # newline='' нужен модулю csv, для GeoJSON переводы строк не важны
+    return io.TextIOWrapper(file, encoding=encoding, newline='')
+
+
+def delete_layer_upload(path):
+    if default_storage.exists(path):
+        default_storage.delete(path)
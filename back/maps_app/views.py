@@ -1,3 +1,4 @@
+import time
 from django.utils import timezone
 from django.db.models import Min, Max, F, BigIntegerField, FloatField
 from django.db.models.functions import Cast
@@ -6,7 +7,7 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from geosight.utils.ModelViewSet import ModelViewSet
-from maps_app.models import (Map, MapLayer, MapStyle, CreateScoringMapLayerTask, Feature, MapLayerFilter, POIConfig,
+from maps_app.models import (Map, MapLayer, MapStyle, CreateScoringMapLayerTask, MapLayerFilter, POIConfig,
                              CreateScoringMapLayerTask)
 from maps_app.serializers.map_layers_serializers import (MapLayerSerializer, MapLayerListSerializer, \
                                                          MapLayerCreateSerializer, MapLayerUpdateSerializer,
@@ -14,7 +15,8 @@ from maps_app.serializers.map_layers_serializers import (MapLayerSerializer, Map
                                                          MapLayerUpdateLineStylesSerializer,
                                                          MapLayerUpdatePointStylesSerializer,
                                                          MapLayerUpdatePolygonStylesSerializer,
-                                                         POISerializer, MapFromMapLayerCreateSerializer)
+                                                         POISerializer, MapFromMapLayerCreateSerializer,
+                                                         MapLayerScoringPreviewSerializer)
 from maps_app.serializers.map_serializers import MapSerializer, MapListSerializer, MapCreateSerializer, \
     MapUpdateSerializer, MapShareSerializer, MapShowSerializer
 from maps_app.serializers.map_layer_filter_serializers import MapLayerFilterListLayerSerializer, \
@@ -26,7 +28,13 @@ from users_app.models import User
 from .serializers.map_serializers import MapAllowedSerializer, MapStyleUpdateSerializer
 from .serializers.map_style_seralizers import MapStyleSerializer
 from .serializers.scoring_layer_serializers import ScoringLayerSerializer, ScoringLayerListSerializer
-from .tasks import create_features, create_scoring_features
+from .tasks import create_features, start_cached_scoring, dispatch_scoring_tasks
+from .utils import get_scoring_cache_key, get_preview_grid, score_preview_grid, get_preview_features, \
+    is_preview_ready
+from .checkpoints import clear_checkpoint
+from .partitions import get_partition_task_ids
+from .uploads import spool_layer_upload
+from .grid_scores import get_layer_sample_properties, get_layer_property_lookup
 from users_app.utils import has_company_access
 from post_office import mail
 from django.conf import settings
@@ -225,6 +233,7 @@ class MapLayerViewSet(ModelViewSet):
         'create': MapLayerCreateSerializer,
         'update': MapLayerUpdateSerializer,
         'scoring': MapLayerScoringCreateSerializer,
+        'scoring_preview': MapLayerScoringPreviewSerializer,
         'properties': MapLayerPropertiesSerializer,
         'line': MapLayerUpdateLineStylesSerializer,
         'point': MapLayerUpdatePointStylesSerializer,
@@ -256,7 +265,8 @@ class MapLayerViewSet(ModelViewSet):
     def get_permissions(self):
         if self.action in ['line', 'point', 'polygon', 'list_filters', 'create_filter', 'delete_filter', 'edit_filter']:
             permission_classes = [IsStaff]
-        elif self.action in ['create', 'update', 'maps_from_create', 'scoring', 'scoring_list', 'scoring_stop', 'poi']:
+        elif self.action in ['create', 'update', 'maps_from_create', 'scoring', 'scoring_preview', 'scoring_list',
+                             'scoring_stop', 'poi']:
             permission_classes = [IsManager]
         else:
             permission_classes = [IsSuperUser]
@@ -269,36 +279,59 @@ class MapLayerViewSet(ModelViewSet):
 
         if file:
             if file.name.endswith(('.geojson', '.csv')):
-                create_features.delay(instance.id, file.name, file.read())
+                # В брокер уходит только путь к файлу в общем хранилище
+                upload_path, checksum = spool_layer_upload(file)
+                create_features.delay(instance.id, file.name, upload_path, checksum)
             else:
                 instance.error = 'Unsupported file type'
                 instance.save()
 
     @action(detail=False, methods=['post'])
     def scoring(self, request):
-        in_progress_tasks = CreateScoringMapLayerTask.objects.filter(
-            status='in_progress').count()
-
-        if in_progress_tasks >= 3:
-            return Response({"detail": "Превышено максимальное количество выполняемых задач. Попробуйте позже."},
-                            status=status.HTTP_429_TOO_MANY_REQUESTS)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        backend, normalization, h3_resolution = data['backend'], data['normalization'], data['h3_resolution']
+        region = data['region']
+        poi_data = [dict(poi) for poi in data['poi']]
+        polygon_radius = data['polygon_radius']
+
+        # Результат с теми же сеткой, POI и параметрами уже посчитан или считается прямо сейчас
+        cache_key = get_scoring_cache_key(poi_data, polygon_radius, normalization, backend, h3_resolution, region)
+        source_task = None
+        if cache_key:
+            source_task = CreateScoringMapLayerTask.objects.filter(
+                cache_key=cache_key, source_task__isnull=True, layer__isnull=False,
+                status__in=['pending', 'in_progress', 'completed']
+            ).order_by('-id').first()
 
         layer = MapLayer.objects.create(
-            name=request.data['name'],
-            description=request.data.get('description', None),
+            name=data['name'],
+            description=data.get('description', None),
             creator=request.user
         )
-        layer.maps.set(request.data['maps'])
-
-        poi_data = request.data.get('poi', [])
-        polygon_radius = request.data.get('polygon_radius', 0)
+        layer.maps.set(data['maps'])
 
         print('poi_data scoring view:', poi_data)
         print('polygon_radius scoring view:', polygon_radius)
-        task = create_scoring_features.delay(layer.id, poi_data, polygon_radius)
-
-        CreateScoringMapLayerTask.objects.create(task_id=task.id, layer=layer,
-                                                 status='in_progress')
+        if source_task is not None:
+            print('scoring view reuses results of task:', source_task.id)
+            task = CreateScoringMapLayerTask.objects.create(task_id='', layer=layer, status='pending', backend=backend,
+                                                            normalization=normalization, h3_resolution=h3_resolution,
+                                                            cache_key=cache_key, source_task=source_task)
+            # Если исходная задача завершилась, копируем сразу, иначе копирование запустит она сама
+            source_task.refresh_from_db(fields=['status'])
+            if source_task.status == 'completed':
+                start_cached_scoring(task)
+        else:
+            # Задача встаёт в очередь, слот ей выдаст диспетчер с учётом лимитов на компанию
+            CreateScoringMapLayerTask.objects.create(task_id='', layer=layer, status='pending',
+                                                     company=request.user.company, backend=backend,
+                                                     normalization=normalization, h3_resolution=h3_resolution,
+                                                     cache_key=cache_key,
+                                                     params={'poi': poi_data, 'polygon_radius': polygon_radius,
+                                                             'region': region})
+            dispatch_scoring_tasks()
 
         queryset = CreateScoringMapLayerTask.objects.all().order_by('-id')
 
@@ -310,6 +343,38 @@ class MapLayerViewSet(ModelViewSet):
             serializer = ScoringLayerListSerializer(page, many=True, context={'request': request})
             return self.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=['post'], url_path='scoring/preview')
+    def scoring_preview(self, request):
+        # Синхронный расчет по окну карты для подбора весов перед полным расчетом слоя
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        poi_data = [dict(poi) for poi in data['poi']]
+        try:
+            ready = is_preview_ready(poi_data)
+        except ValueError as error:
+            return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        if not ready:
+            # Сборка кэша сетки или снимка POI заняла бы запрос надолго, её делают фоновые задачи
+            return Response({"detail": "Данные для предпросмотра еще готовятся. Повторите позже."},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        started = time.perf_counter()
+        grid = get_preview_grid(data['bbox'])
+        if len(grid) > settings.SCORING_PREVIEW_MAX_CELLS:
+            return Response({"detail": f"В окне {len(grid)} ячеек, для предпросмотра не больше "
+                                       f"{settings.SCORING_PREVIEW_MAX_CELLS}. Приблизьте карту."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        grid, metrics = score_preview_grid(grid, poi_data, data['polygon_radius'],
+                                           data.get('normalization') or settings.SCORING_NORMALIZATION,
+                                           data['approximate'])
+        features = get_preview_features(grid, poi_data)
+        features['metadata'] = {'cells': len(grid), 'seconds': round(time.perf_counter() - started, 3),
+                                'stages': metrics['stages']}
+        return Response(features, status=status.HTTP_200_OK)
+
     @action(methods=['get'], detail=False)
     def poi(self, request):
         poi_queryset = POIConfig.objects.all()
@@ -319,12 +384,11 @@ class MapLayerViewSet(ModelViewSet):
     @action(detail=True, methods=['get'])
     def properties(self, request, pk=None):
         map_layer = self.get_object()
-        features = Feature.objects.filter(map_layer=map_layer)
+        sample_properties = get_layer_sample_properties(map_layer)
 
-        if not features.exists():
+        if sample_properties is None:
             return Response([], status=status.HTTP_200_OK)
 
-        sample_properties = features.first().properties
         unique_keys = []
 
         type_mapping = {
@@ -372,8 +436,8 @@ class MapLayerViewSet(ModelViewSet):
         if not property_name:
             return Response({"detail": "Параметр 'property_name' обязателен."}, status=status.HTTP_400_BAD_REQUEST)
 
-        features = Feature.objects.filter(map_layer=map_layer).values_list(f'properties__{property_name}',
-                                                                           flat=True).distinct()
+        queryset, lookup = get_layer_property_lookup(map_layer, property_name)
+        features = queryset.values_list(lookup, flat=True).distinct()
 
         if not features.exists():
             return Response({"detail": f"No features found with the property '{property_name}'."},
@@ -383,22 +447,22 @@ class MapLayerViewSet(ModelViewSet):
 
         if isinstance(sample_value, expected_type):
             if expected_type in [int, float]:
-                return self._get_numeric_property_values(features, sample_value, property_name)
+                return self._get_numeric_property_values(features, sample_value, lookup)
             elif expected_type == str:
                 return self._get_string_property_values(features, request)
         else:
             return Response({"detail": f"Property '{property_name}' is not of type {expected_type.__name__}."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-    def _get_numeric_property_values(self, features, sample_value, property_name):
+    def _get_numeric_property_values(self, features, sample_value, lookup):
         features_casted = None
         if isinstance(sample_value, int):
             features_casted = features.annotate(
-                property_value_casted=Cast(F(f'properties__{property_name}'), output_field=BigIntegerField())
+                property_value_casted=Cast(F(lookup), output_field=BigIntegerField())
             )
         elif isinstance(sample_value, float):
             features_casted = features.annotate(
-                property_value_casted=Cast(F(f'properties__{property_name}'), output_field=FloatField())
+                property_value_casted=Cast(F(lookup), output_field=FloatField())
             )
         if features_casted:
             min_value = features_casted.aggregate(min_value=Min('property_value_casted'))['min_value']
@@ -552,15 +616,30 @@ class MapLayerViewSet(ModelViewSet):
         scoring_task_id = request.query_params.get('id')
         task = CreateScoringMapLayerTask.objects.get(id=scoring_task_id)
 
-        if request.user.is_manager and not has_company_access(request.user, task.layer.maps().first()):
+        layer_map = task.layer.maps().first() if task.layer else None
+        if request.user.is_manager and not has_company_access(request.user, layer_map):
             return Response({"detail": "У вас нет доступа к этому слою."}, status=status.HTTP_403_FORBIDDEN)
 
         if task.status == 'in_progress':
-            app.control.revoke(task.task_id, terminate=True)
+            # Распределенный расчет идёт ещё и в задачах частей сетки
+            app.control.revoke([task.task_id, *get_partition_task_ids(task)], terminate=True)
+            task.status = 'killed'
+            task.end_time = timezone.now()
+            clear_checkpoint(task)
+            task.save()
+            task.fail_followers('Задача с результатом расчета была остановлена')
+            if task.layer:
+                task.layer.delete()
+            dispatch_scoring_tasks()
+        elif task.status == 'pending':
+            # Из очереди задача просто снимается
             task.status = 'killed'
             task.end_time = timezone.now()
+            clear_checkpoint(task)
             task.save()
-            task.layer.delete()
+            task.fail_followers('Задача с результатом расчета была остановлена')
+            if task.layer:
+                task.layer.delete()
 
         queryset = CreateScoringMapLayerTask.objects.all().order_by('-id')
 